@@ -0,0 +1,275 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# Benchmark harness: generates synthetic monthly FuelCheck files, times the
+# cleaning, export, load and query steps on them and compares the timings (and
+# result checksums) against a stored baseline.
+#
+#   python bench.py --scale 1m                     # run and compare
+#   python bench.py --scale 1m --update-baseline   # record a new baseline
+#
+# The committed baseline holds the result checks of the smoke scale; timings
+# depend on the machine and are compared once recorded with --update-baseline.
+
+SCALES = {'smoke': 100_000, '1m': 1_000_000, '10m': 10_000_000, '50m': 50_000_000}
+BENCH_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+# A step counts as a regression when it is this much slower than the baseline
+REGRESSION_TOLERANCE = 0.25
+# Rows generated per write, so 50M-row runs do not hold a whole month in memory
+GENERATE_CHUNK_ROWS = 1_000_000
+
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+BRANDS = ['Ampol', 'BP', 'Shell', '7-Eleven', 'Caltex', 'Metro Fuel', 'United', 'Costco', 'Coles Express', 'Independent']
+STREETS = ['Pacific', 'Princes', 'Great Western', 'Hume', 'New England', 'Parramatta', 'Victoria', 'King', 'George', 'Church']
+STREET_TYPES = ['Hwy', 'Rd', 'St', 'Ave', 'Dr', 'Pde']
+SUBURB_PARTS = (['North', 'South', 'East', 'West', 'Upper', 'Lower', ''],
+                ['Bank', 'Glen', 'Wood', 'Ridge', 'Vale', 'Field', 'Brook', 'Hill', 'Haven', 'Park'],
+                ['stown', 'ville', 'ford', 'ton', 'worth', 'wood', 'field', ''])
+# Fuel code, share of price updates, typical price in cents
+FUEL_CODES = [('U91', 0.30, 185.0), ('E10', 0.22, 182.0), ('P95', 0.15, 199.0), ('P98', 0.13, 209.0),
+              ('DL', 0.12, 195.0), ('PDL', 0.05, 205.0), ('LPG', 0.02, 105.0), ('E85', 0.01, 170.0)]
+
+# Station pool: name, address, suburb, postcode, brand, coordinates and a
+# per-station price offset
+def generate_stations(count, rng):
+    prefixes, stems, suffixes = SUBURB_PARTS
+    suburb_names = sorted({f"{rng.choice(prefixes)} {rng.choice(stems)}{rng.choice(suffixes)}".strip()
+                           for _ in range(count)})
+    suburbs = rng.choice(suburb_names, count)
+    postcodes = rng.integers(2000, 2900, count)
+    brands = rng.choice(BRANDS, count)
+    numbers = rng.integers(1, 999, count)
+    streets = rng.choice(STREETS, count)
+    street_types = rng.choice(STREET_TYPES, count)
+    return pd.DataFrame({
+        'ServiceStationName': [f"{brand} {suburb}" for brand, suburb in zip(brands, suburbs)],
+        'Address': [f"{number} {street} {street_type}, {suburb} NSW {postcode}"
+                    for number, street, street_type, suburb, postcode in zip(numbers, streets, street_types, suburbs, postcodes)],
+        'Suburb': suburbs,
+        'Postcode': postcodes,
+        'Brand': brands,
+        'Latitude': rng.uniform(-37.5, -28.2, count).round(6),
+        'Longitude': rng.uniform(141.0, 153.6, count).round(6),
+        'PriceOffset': rng.normal(0, 6, count),
+    })
+
+# One chunk of price updates for a month, with the defects seen in the real
+# files: blank dates, out-of-range prices, padded text, empty rows and repeats
+def generate_rows(stations, year, month, rows, rng):
+    codes, shares, base_prices = zip(*FUEL_CODES)
+    station_index = rng.integers(0, len(stations), rows)
+    fuel_index = rng.choice(len(codes), rows, p=np.array(shares) / sum(shares))
+    month_start = pd.Timestamp(year=year, month=month, day=1)
+    seconds = (month_start + pd.offsets.MonthBegin(1) - month_start).total_seconds()
+    dates = month_start + pd.to_timedelta(rng.integers(0, int(seconds), rows), unit='s')
+    prices = (np.array(base_prices)[fuel_index] + stations['PriceOffset'].to_numpy()[station_index]
+              + rng.normal(0, 4, rows)).round(1)
+
+    chunk = stations.iloc[station_index][['ServiceStationName', 'Address', 'Suburb', 'Postcode', 'Brand']].reset_index(drop=True)
+    chunk['FuelCode'] = np.array(codes)[fuel_index]
+    chunk['PriceUpdatedDate'] = dates.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=object)
+    chunk['Price'] = prices
+
+    chunk.loc[rng.random(rows) < 0.005, 'PriceUpdatedDate'] = None
+    out_of_range = rng.random(rows) < 0.002
+    chunk.loc[out_of_range, 'Price'] = rng.choice([0.0, 9.9, 999.9, 1899.0], out_of_range.sum())
+    padded = rng.random(rows) < 0.01
+    chunk.loc[padded, 'ServiceStationName'] = ' ' + chunk.loc[padded, 'ServiceStationName'] + ' '
+    chunk.loc[rng.random(rows) < 0.0005, :] = None
+
+    duplicates = chunk.sample(frac=0.01, random_state=int(rng.integers(0, 2**31)))
+    return pd.concat([chunk, duplicates], ignore_index=True)
+
+# Write `rows` price updates spread over `months` monthly CSVs named like the
+# published files (e.g. fuelcheck-jan2024.csv). Returns the [(link, path)]
+# list that fetch_monthly_files() would, and the station pool.
+def generate_dataset(rows, months=3, out_dir='bench_data', seed=0, stations=3000):
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    station_pool = generate_stations(stations, rng)
+    monthly_files = []
+    rows_per_month = rows // months
+    for i in range(months):
+        year, month = 2024 + i // 12, i % 12 + 1
+        filename = f"fuelcheck-{MONTH_NAMES[month - 1]}{year}.csv"
+        path = os.path.join(out_dir, filename)
+        remaining = rows_per_month + (rows % months if i == months - 1 else 0)
+        header = True
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            while remaining > 0:
+                chunk_rows = min(remaining, GENERATE_CHUNK_ROWS)
+                generate_rows(station_pool, year, month, chunk_rows, rng).to_csv(f, index=False, header=header)
+                header = False
+                remaining -= chunk_rows
+        monthly_files.append((f"https://example.invalid/{filename}", path))
+    return monthly_files, station_pool
+
+def _fuel_details_frame(monthly_files):
+    months = sorted({os.path.basename(path)[10:-4] for _, path in monthly_files})
+    rows = []
+    for month in months:
+        date = pd.to_datetime(month, format='%b%Y')
+        for code, _, _ in FUEL_CODES:
+            rows.append({'Month': date.strftime('%m-%Y'), 'Product': f'{code} sales (ML)',
+                         'SalesValue': 100.0, 'FuelCode': code})
+    return pd.DataFrame(rows)
+
+# Run fn `repeat` times with its printing silenced; returns (best seconds, last result)
+def _timed(fn, repeat=1):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - started)
+    return best, result
+
+# Time every step on a generated dataset inside work_dir (the pipeline writes
+# its outputs relative to the working directory; without work_dir a temporary
+# directory is used and removed afterwards). Returns {'timings': {step:
+# seconds}, 'checks': {name: value}}.
+def run_benchmarks(rows, months=3, seed=0, repeat=3, work_dir=None):
+    from data_retrieval import retrieve_fuelcheck_monthly_data
+    from data_integration import data_cleaning, convert_cleaned_data_to_csv, convert_cleaned_data_to_parquet
+    from data_transformation import store_to_duckdb
+    from data_analytics import price_summary, average_price_by_fuelcode, cheapest_by, available_months
+    from data_spatial import cheapest_within, nearest_stations
+    from data_history import price_at, prices_as_of
+
+    temporary_dir = None
+    if work_dir is None:
+        work_dir = temporary_dir = tempfile.mkdtemp(prefix='fuelcheck-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        timings = {}
+        timings['generate'], (monthly_files, stations) = _timed(
+            lambda: generate_dataset(rows, months, 'bench_data', seed))
+
+        timings['load_files'], raw = _timed(lambda: retrieve_fuelcheck_monthly_data(monthly_files))
+        raw_rows = len(raw)
+        timings['data_cleaning'], cleaned = _timed(lambda: data_cleaning(raw))
+        del raw
+        timings['convert_cleaned_data_to_csv'], _ = _timed(lambda: convert_cleaned_data_to_csv(cleaned))
+        timings['convert_cleaned_data_to_parquet'], parquet_path = _timed(lambda: convert_cleaned_data_to_parquet(cleaned))
+
+        # The last station is left ungeocoded: its prices are flagged but must still load
+        geo_mapping = stations[['Address', 'Latitude', 'Longitude']].iloc[:-1]
+        timings['store_to_duckdb'], _ = _timed(
+            lambda: store_to_duckdb(parquet_path, _fuel_details_frame(monthly_files), geo_mapping.copy()))
+
+        first_month = available_months()[0]
+        point = (float(stations['Latitude'].iloc[0]), float(stations['Longitude'].iloc[0]))
+        # (station, time) lookups spread over the loaded months
+        lookup_rng = np.random.default_rng(seed)
+        lookups = pd.DataFrame({
+            'station_id': lookup_rng.integers(1, len(stations) + 1, 10000),
+            'fuelcode': 'U91',
+            'at': pd.Timestamp(first_month) + pd.to_timedelta(lookup_rng.integers(0, months * 28 * 86400, 10000), unit='s'),
+        })
+        queries = {
+            'price_summary': lambda: price_summary('month', 'brand'),
+            'average_price_by_fuelcode': average_price_by_fuelcode,
+            'cheapest_by': lambda: cheapest_by('U91', first_month, 'suburb'),
+            'available_months': available_months,
+            'cheapest_within': lambda: cheapest_within('U91', point[0], point[1], 25.0),
+            'nearest_stations': lambda: nearest_stations('U91', point[0], point[1], 5),
+            'price_at': lambda: price_at(1, 'U91', lookups['at'].iloc[0]),
+            'prices_as_of_10k': lambda: prices_as_of(lookups),
+        }
+        for name, query in queries.items():
+            timings[f'query_{name}'], _ = _timed(query, repeat)
+
+        averages = average_price_by_fuelcode()
+        checks = {
+            'raw_rows': raw_rows,
+            'cleaned_rows': len(cleaned),
+            'loaded_rows': int(averages['price_count'].sum()),
+            'average_price': {row.fuelcode: round(float(row.avg_price), 4) for row in averages.itertuples()},
+        }
+        return {'timings': {name: round(seconds, 4) for name, seconds in timings.items()}, 'checks': checks}
+    finally:
+        os.chdir(previous_dir)
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+# Compare a run with the baseline entry for the same dataset. Returns a list of
+# problems: checksum mismatches and steps slower than the tolerance allows.
+def compare_to_baseline(result, baseline, tolerance=REGRESSION_TOLERANCE):
+    problems = []
+    for name, expected in baseline['checks'].items():
+        if result['checks'].get(name) != expected:
+            problems.append(f"{name}: expected {expected}, got {result['checks'].get(name)}")
+
+    print(f"{'step':<36} {'seconds':>10} {'baseline':>10} {'ratio':>7}")
+    for name, seconds in result['timings'].items():
+        expected = baseline.get('timings', {}).get(name)
+        if expected is None:
+            print(f"{name:<36} {seconds:>10.4f} {'-':>10} {'-':>7}")
+            continue
+        ratio = seconds / expected if expected else float('inf')
+        flag = ''
+        if name != 'generate' and ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            problems.append(f"{name}: {seconds:.4f}s vs baseline {expected:.4f}s ({ratio:.2f}x)")
+        print(f"{name:<36} {seconds:>10.4f} {expected:>10.4f} {ratio:>6.2f}x{flag}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the FuelCheck pipeline on synthetic data")
+    parser.add_argument('--scale', default='smoke', help=f"one of {sorted(SCALES)} or a row count")
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per query (the fastest counts)")
+    parser.add_argument('--work-dir', help="keep the generated files and database here")
+    parser.add_argument('--baseline', default=BENCH_BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    rows = SCALES[args.scale] if args.scale in SCALES else int(args.scale)
+    key = f"rows={rows},months={args.months},seed={args.seed}"
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baselines = json.load(f)
+    # Without a baseline there is nothing to catch regressions against
+    if key not in baselines and not args.update_baseline:
+        print(f"No baseline for {key} in {args.baseline}; record one with --update-baseline")
+        return 2
+
+    print(f"Benchmarking {key}")
+    result = run_benchmarks(rows, args.months, args.seed, args.repeat, args.work_dir)
+
+    if args.update_baseline:
+        for name, seconds in result['timings'].items():
+            print(f"{name:<36} {seconds:>10.4f}")
+        baselines[key] = result
+        tmp_file = args.baseline + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, args.baseline)
+        print(f"Baseline for {key} saved to {args.baseline}")
+        return 0
+
+    problems = compare_to_baseline(result, baselines[key], args.tolerance)
+    if problems:
+        print("\nRegressions against the baseline:")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    print("\nNo regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
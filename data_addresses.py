@@ -0,0 +1,55 @@
+import hashlib
+import re
+import numpy as np
+import pandas as pd
+
+STATES = ['NSW', 'ACT', 'VIC', 'QLD', 'SA', 'WA', 'TAS', 'NT']
+STREET_ABBREVIATIONS = {
+    'RD': 'ROAD', 'ST': 'STREET', 'HWY': 'HIGHWAY', 'AVE': 'AVENUE', 'AV': 'AVENUE',
+    'DR': 'DRIVE', 'PDE': 'PARADE', 'CRES': 'CRESCENT', 'CT': 'COURT', 'PL': 'PLACE',
+    'TCE': 'TERRACE', 'BLVD': 'BOULEVARD', 'HWAY': 'HIGHWAY', 'LN': 'LANE', 'CNR': 'CORNER',
+    'MT': 'MOUNT', 'ESP': 'ESPLANADE', 'CCT': 'CIRCUIT', 'CL': 'CLOSE', 'SQ': 'SQUARE',
+}
+# Words dropped from street names so "The Northern Rd" and "Northern Road" agree
+STREET_STOPWORDS = {'THE'}
+
+# Split a FuelCheck address such as "5/100 Eastern Rd, Bungarribee NSW 2767"
+# into (street, suburb, postcode); parts that are missing come back as ''
+def split_station_address(address):
+    pattern = r'^(.*),\s*(.+?)\s+(?:' + '|'.join(STATES) + r')\s+(\d{4})\s*$'
+    match = re.match(pattern, str(address).strip(), re.IGNORECASE)
+    if not match:
+        return str(address).strip(), '', ''
+    return match.group(1), match.group(2), match.group(3)
+
+# Canonical street: upper case, punctuation folded, unit/lot numbers written as
+# "UNIT/NUMBER", abbreviations expanded and stopwords removed
+def canonical_street(street):
+    text = str(street).upper()
+    text = re.sub(r'\b(?:UNIT|SHOP|SUITE|U)\s*(\w+)\s*[,/]?\s*(?=\d)', r'\1/', text)
+    text = re.sub(r'\s*/\s*', '/', text)
+    text = re.sub(r'(\d)\s*-\s*(\d)', r'\1-\2', text)
+    tokens = re.sub(r'[^\w/\-]+', ' ', text).split()
+    return ' '.join(STREET_ABBREVIATIONS.get(token, token) for token in tokens if token not in STREET_STOPWORDS)
+
+# Canonical form of a whole address: "STREET, SUBURB POSTCODE" (state dropped)
+def canonical_address(address):
+    if address is None or (isinstance(address, float) and np.isnan(address)):
+        return ''
+    street, suburb, postcode = split_station_address(address)
+    locality = ' '.join(part for part in [' '.join(suburb.upper().split()), postcode] if part)
+    return f"{canonical_street(street)}, {locality}" if locality else canonical_street(street)
+
+# Stable signed 64-bit key of the canonical address (same value on every run and
+# machine, unlike Python's hash()), used as the GEO_MAPPING join key
+def address_key(address):
+    digest = hashlib.blake2b(canonical_address(address).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+# address_key for a whole column, computed once per distinct address
+def address_keys(addresses):
+    codes, uniques = pd.factorize(addresses)
+    unique_keys = np.array([address_key(address) for address in uniques], dtype='int64')
+    keys = pd.array(unique_keys[codes] if len(uniques) else np.zeros(len(codes), dtype='int64'), dtype='Int64')
+    keys[codes == -1] = pd.NA
+    return pd.Series(keys, index=addresses.index, name='AddressKey')
@@ -0,0 +1,244 @@
+import duckdb
+from datetime import date
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+# pandas is only needed for the DataFrame results (fetchdf imports it), so
+# query-only callers start without it
+if TYPE_CHECKING:
+    import pandas as pd
+
+DB_PATH = "db/fuelcheck.duckdb"
+
+# Dimensions the rollups are grouped by (always together with fuelcode)
+ROLLUP_DIMENSIONS = ['fuelcode', 'brand', 'suburb', 'postcode']
+
+def create_rollup_tables(con):
+    # Daily and monthly price statistics. Each row belongs to one grouping
+    # ('fuelcode', 'brand', 'suburb' or 'postcode'); dimensions outside that
+    # grouping are NULL. The average is kept as sum/count so rollups can be
+    # combined across days and groups.
+    for table, period in [('price_rollup_daily', 'day'), ('price_rollup_monthly', 'month')]:
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {period} DATE,
+                grouping VARCHAR,
+                fuelcode VARCHAR(3),
+                brand TEXT,
+                suburb TEXT,
+                postcode INTEGER,
+                min_price FLOAT,
+                max_price FLOAT,
+                sum_price DOUBLE,
+                price_count BIGINT
+            );
+        """)
+
+# Recompute the rollups for the given months (datetime.date month starts), or
+# for everything when months is None. Meant to run inside the load transaction.
+def refresh_price_rollups(con, months=None):
+    create_rollup_tables(con)
+
+    if months is None:
+        con.execute("DELETE FROM price_rollup_daily")
+        con.execute("DELETE FROM price_rollup_monthly")
+        month_filter = ""
+        params = []
+    else:
+        if not months:
+            return
+        con.execute("DELETE FROM price_rollup_daily WHERE date_trunc('month', day) IN (SELECT UNNEST(?::DATE[]))", [months])
+        con.execute("DELETE FROM price_rollup_monthly WHERE month IN (SELECT UNNEST(?::DATE[]))", [months])
+        month_filter = "WHERE fuel_date IN (SELECT UNNEST(?::DATE[]))"
+        params = [months]
+
+    con.execute(f"""
+        INSERT INTO price_rollup_daily
+        SELECT day,
+               CASE WHEN GROUPING(brand) = 0 THEN 'brand'
+                    WHEN GROUPING(suburb) = 0 THEN 'suburb'
+                    WHEN GROUPING(postcode) = 0 THEN 'postcode'
+                    ELSE 'fuelcode' END AS grouping,
+               fuelcode, brand, suburb, postcode,
+               MIN(price), MAX(price), SUM(price), COUNT(*)
+        FROM (
+            SELECT CAST(priceupdateddate AS DATE) AS day, fuelcode, brand, suburb, postcode, price
+            FROM fuel_data
+            {month_filter}
+        ) prices
+        GROUP BY GROUPING SETS (
+            (day, fuelcode),
+            (day, fuelcode, brand),
+            (day, fuelcode, suburb),
+            (day, fuelcode, postcode)
+        )
+        ORDER BY day
+    """, params)
+
+    # Monthly rollups are built from the daily ones rather than the raw prices
+    daily_filter = "WHERE date_trunc('month', day) IN (SELECT UNNEST(?::DATE[]))" if months is not None else ""
+    con.execute(f"""
+        INSERT INTO price_rollup_monthly
+        SELECT CAST(date_trunc('month', day) AS DATE) AS month, grouping,
+               fuelcode, brand, suburb, postcode,
+               MIN(min_price), MAX(max_price), SUM(sum_price), SUM(price_count)
+        FROM price_rollup_daily
+        {daily_filter}
+        GROUP BY ALL
+        ORDER BY month
+    """, params)
+    print(f"Refreshed price rollups for {'all' if months is None else len(months)} months")
+
+# The report queries below are built as (sql, params) so they can run without
+# pandas (see main.py's query command); the functions of the same name without
+# _query return them as DataFrames.
+
+# Price statistics per period ('day' or 'month') and per group ('fuelcode',
+# 'brand', 'suburb' or 'postcode'), read from the rollup tables
+def price_summary_query(
+    period: str = 'month',
+    by: str = 'fuelcode',
+    fuelcode: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> Tuple[str, list]:
+    if period not in ('day', 'month'):
+        raise ValueError(f"period must be 'day' or 'month', not {period!r}")
+    if by not in ROLLUP_DIMENSIONS:
+        raise ValueError(f"by must be one of {ROLLUP_DIMENSIONS}, not {by!r}")
+
+    table = 'price_rollup_daily' if period == 'day' else 'price_rollup_monthly'
+    group_columns = 'fuelcode' if by == 'fuelcode' else f'fuelcode, {by}'
+    conditions = ["grouping = ?"]
+    params = [by]
+    if fuelcode is not None:
+        conditions.append("fuelcode = ?")
+        params.append(fuelcode)
+    if start is not None:
+        conditions.append(f"{period} >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{period} <= ?")
+        params.append(end)
+
+    return f"""
+        SELECT {period}, {group_columns},
+               min_price, sum_price / price_count AS avg_price, max_price, price_count
+        FROM {table}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {period}, {group_columns}
+    """, params
+
+def price_summary(
+    period: str = 'month',
+    by: str = 'fuelcode',
+    fuelcode: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db_path: str = DB_PATH,
+) -> 'pd.DataFrame':
+    return query_df(*price_summary_query(period, by, fuelcode, start, end), db_path=db_path)
+
+# Average price per fuel code over the whole range (or between start and end)
+def average_price_by_fuelcode_query(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> Tuple[str, list]:
+    conditions = ["grouping = 'fuelcode'"]
+    params = []
+    if start is not None:
+        conditions.append("day >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("day <= ?")
+        params.append(end)
+
+    return f"""
+        SELECT fuelcode,
+               SUM(sum_price) / SUM(price_count) AS avg_price,
+               MIN(min_price) AS min_price,
+               MAX(max_price) AS max_price,
+               SUM(price_count) AS price_count
+        FROM price_rollup_daily
+        WHERE {' AND '.join(conditions)}
+        GROUP BY fuelcode
+        ORDER BY avg_price DESC
+    """, params
+
+def average_price_by_fuelcode(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db_path: str = DB_PATH,
+) -> 'pd.DataFrame':
+    return query_df(*average_price_by_fuelcode_query(start, end), db_path=db_path)
+
+# Cheapest groups (e.g. suburbs) for one fuel code in one month
+def cheapest_by_query(
+    fuelcode: str,
+    month: date,
+    by: str = 'suburb',
+    limit: int = 10,
+) -> Tuple[str, list]:
+    if by not in ROLLUP_DIMENSIONS[1:]:
+        raise ValueError(f"by must be one of {ROLLUP_DIMENSIONS[1:]}, not {by!r}")
+
+    return f"""
+        SELECT {by}, sum_price / price_count AS avg_price, min_price, max_price, price_count
+        FROM price_rollup_monthly
+        WHERE grouping = ? AND fuelcode = ? AND month = date_trunc('month', ?::DATE)
+        ORDER BY avg_price
+        LIMIT ?
+    """, [by, fuelcode, month, limit]
+
+def cheapest_by(
+    fuelcode: str,
+    month: date,
+    by: str = 'suburb',
+    limit: int = 10,
+    db_path: str = DB_PATH,
+) -> 'pd.DataFrame':
+    return query_df(*cheapest_by_query(fuelcode, month, by, limit), db_path=db_path)
+
+# Months present in the monthly rollup, oldest first
+def available_months_query() -> Tuple[str, list]:
+    return "SELECT DISTINCT month FROM price_rollup_monthly ORDER BY month", []
+
+def available_months(db_path: str = DB_PATH) -> List[date]:
+    columns, rows = query_rows(*available_months_query(), db_path=db_path)
+    return [row[0] for row in rows]
+
+# SQL literal for a report parameter (text, number, date or None)
+def _sql_literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Run a query on a read-only connection: the column names and rows as tuples.
+# Binding Python parameters makes duckdb import pandas (to recognise its
+# missing values), most of the start-up of a short query, so the ? of the
+# report queries are filled in as literals instead.
+def query_rows(sql: str, params: Optional[list] = None, db_path: str = DB_PATH) -> Tuple[List[str], list]:
+    if params:
+        parts = sql.split('?')
+        if len(parts) != len(params) + 1:
+            raise ValueError(f"Query has {len(parts) - 1} parameters, {len(params)} given")
+        sql = parts[0] + "".join(_sql_literal(value) + part for value, part in zip(params, parts[1:]))
+    con = duckdb.connect(db_path, read_only=True)
+    try:
+        cursor = con.execute(sql)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+    finally:
+        con.close()
+
+# Run a query on a read-only connection and return a DataFrame
+def query_df(sql: str, params: Optional[list] = None, db_path: str = DB_PATH) -> 'pd.DataFrame':
+    con = duckdb.connect(db_path, read_only=True)
+    try:
+        return con.execute(sql, params or []).fetchdf()
+    finally:
+        con.close()
@@ -1,18 +1,58 @@
 import pandas as pd
 import os
 import csv
+import re
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited
+from rapidfuzz import fuzz, process
+from data_addresses import address_key, canonical_address, canonical_street, split_station_address
 
-def fuel_details(output_csv='data/fuel.csv'):
+GEOCODE_CACHE_PATH = 'db/geocode_cache.sqlite'
+# Addresses that could not be found are retried after this many days
+NEGATIVE_RESULT_TTL_DAYS = 30
+GEOCODE_MAX_RETRIES = 5
+RETRYABLE_GEOCODER_ERRORS = (GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited)
+
+# Bundled data for offline geocoding: previously geocoded station addresses
+# (with coordinates) and the national petrol station register (GNAF-formatted
+# addresses, no coordinates). The bundled files in data/ are only read.
+OFFLINE_REFERENCE_FILES = ['data/fuel_prices_with_lat_lng.csv', 'data/unique_addresses_with_lat_lng.csv']
+STATION_REGISTER_FILE = 'data/147635_01_0.csv'
+# Minimum fuzzy street score (0-100) for an offline match
+OFFLINE_MIN_SCORE = 90
+# Generated outputs (db/ is not tracked): the fuel details built from the
+# product sales, and the geocoder output
+FUEL_DETAILS_OUTPUT = 'db/fuel.csv'
+GEOCODED_ADDRESSES_OUTPUT = 'db/unique_addresses_with_lat_lng.csv'
+# Reference files in data/ are kept as .txt in the repository and may be .csv
+# locally; both hold the same CSV text
+DATA_FILE_EXTENSIONS = ['.csv', '.txt']
+
+# The path a data file actually exists under, trying the given name first and
+# then the other extensions. Returns the given path when none exist (e.g. an
+# output that has not been written yet).
+def resolve_data_file(path):
+    stem, extension = os.path.splitext(path)
+    if extension not in DATA_FILE_EXTENSIONS or os.path.exists(path):
+        return path
+    for other_extension in DATA_FILE_EXTENSIONS:
+        candidate = stem + other_extension
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+def fuel_details(output_csv=FUEL_DETAILS_OUTPUT, overwrite=False):
     # check if output already exists
-    if os.path.exists(output_csv):
+    if os.path.exists(output_csv) and not overwrite:
         print(f"File '{output_csv}' already exists. Skipping fuel processing.")
         return
 
     # Load fuel sales dataset
-    df = pd.read_csv("data/ProductSales - Sheet1.csv")
+    df = pd.read_csv(resolve_data_file("data/ProductSales - Sheet1.csv"))
 
     # Melt df
     df_long = pd.melt(df, 
@@ -71,60 +111,285 @@ def fuel_details(output_csv='data/fuel.csv'):
     df_filtered.to_csv(output_csv, index=False)
     print(f"Fuel data processed and saved to {output_csv}")
 
-def geocode_unique_addresses(input_csv_file='cleaned_fuelcheck_data.csv', output_csv_file='data/unique_addresses_with_lat_lng.csv'):
-    # check if output already exists
-    if os.path.exists(output_csv_file):
-        print(f"File '{output_csv_file}' already exists. Skipping geocoding.")
-        return
+# Persistent geocode results keyed by canonical address. Misses are stored too
+# and count as cached until they are older than the negative-result TTL.
+class GeocodeCache:
+    def __init__(self, path=GEOCODE_CACHE_PATH, negative_ttl_days=NEGATIVE_RESULT_TTL_DAYS):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.negative_ttl = negative_ttl_days * 86400
+        self.con = sqlite3.connect(path)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                address_key TEXT PRIMARY KEY,
+                query TEXT,
+                latitude REAL,
+                longitude REAL,
+                provider TEXT,
+                updated_at REAL
+            )
+        """)
+
+    def get(self, address):
+        row = self.con.execute(
+            "SELECT latitude, longitude, updated_at FROM geocode_cache WHERE address_key = ?",
+            (canonical_address(address),)
+        ).fetchone()
+        if row is None:
+            return None
+        latitude, longitude, updated_at = row
+        if latitude is None and time.time() - updated_at > self.negative_ttl:
+            return None
+        return latitude, longitude
+
+    def put(self, address, query, latitude, longitude, provider):
+        self.con.execute(
+            "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?, ?, ?)",
+            (canonical_address(address), query, latitude, longitude, provider, time.time())
+        )
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+# Offline geocoder: an in-memory index over the bundled reference addresses,
+# blocked by postcode and suburb, with token-based fuzzy matching on the street.
+# House and unit numbers must agree exactly, so neighbouring sites never match.
+class OfflineGeocoder:
+    name = 'offline'
+    rate_limit = float('inf')
+    max_concurrency = 1
+
+    def __init__(self, reference_files=OFFLINE_REFERENCE_FILES, register_file=STATION_REGISTER_FILE,
+                 min_score=OFFLINE_MIN_SCORE):
+        self.min_score = min_score
+        self.blocks = {}
+        self.register_blocks = {}
+
+        for reference_file in reference_files:
+            reference_file = resolve_data_file(reference_file)
+            if not os.path.exists(reference_file):
+                continue
+            reference = pd.read_csv(reference_file).dropna(subset=['Latitude', 'Longitude'])
+            for address, lat, lng in zip(reference['Address'], reference['Latitude'], reference['Longitude']):
+                street, suburb, postcode = split_station_address(address)
+                self._add(self.blocks, street, suburb, postcode, (float(lat), float(lng)))
+
+        register_file = resolve_data_file(register_file) if register_file else None
+        if register_file and os.path.exists(register_file):
+            register = pd.read_csv(register_file, encoding='utf-8-sig', dtype=str).dropna(subset=['GNAF_FORMATTED_ADDRESS'])
+            for street, suburb, postcode, state in zip(register['GNAF_FORMATTED_ADDRESS'], register['GNAF_SUBURB'].fillna(''),
+                                                       register['GNAF_POSTCODE'].fillna(''), register['STATION_STATE'].fillna('')):
+                postcode = postcode.split('.')[0]
+                self._add(self.register_blocks, street, suburb, postcode, f"{street}, {suburb} {state} {postcode}".strip())
+
+    @staticmethod
+    def _add(blocks, street, suburb, postcode, value):
+        entry = (canonical_street(street), value)
+        if postcode:
+            blocks.setdefault(('postcode', postcode), []).append(entry)
+        if suburb:
+            blocks.setdefault(('suburb', suburb.strip().upper()), []).append(entry)
+
+    def _best(self, blocks, address, suburb=''):
+        street, address_suburb, postcode = split_station_address(address)
+        suburb = (address_suburb or suburb or '').strip().upper()
+        candidates = blocks.get(('postcode', postcode), []) + blocks.get(('suburb', suburb), [])
+        if not candidates:
+            return None
+
+        query = canonical_street(street)
+        numbers = re.findall(r'\d+', query)
+        matches = process.extract(query, [candidate[0] for candidate in candidates],
+                                  scorer=fuzz.token_set_ratio, score_cutoff=self.min_score, limit=5)
+        for _, score, index in matches:
+            candidate_street, value = candidates[index]
+            if re.findall(r'\d+', candidate_street) == numbers:
+                return value, round(score / 100, 3)
+        return None
 
-    geolocator = Nominatim(user_agent="fuel_address_locator", timeout=10)
+    # (lat, lng, confidence) for an address, or None when nothing matches well enough
+    def match(self, address, suburb=''):
+        best = self._best(self.blocks, address, suburb)
+        if best is None:
+            return None
+        (lat, lng), confidence = best
+        return lat, lng, confidence
 
-    # Sets to hold unique (Address, Suburb) pairs
-    unique_entries = set()
+    # GNAF-formatted address from the station register, used as a cleaner query
+    # for the network geocoder; None when the register has no match
+    def canonical_query(self, address, suburb=''):
+        best = self._best(self.register_blocks, address, suburb)
+        return best[0] if best else None
 
-    # Extract unique address + suburb pairs from input CSV
-    with open(input_csv_file, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            address = row['Address'].strip()
-            suburb = row['Suburb'].strip()
-            unique_entries.add((address, suburb))
+    def geocode(self, query):
+        location = self.match(query)
+        return location[:2] if location else None
 
-    # Function to get lat/lng with retry
-    def get_lat_lng(query):
+# Token bucket shared by the geocoding threads: at most `rate` requests per
+# second on average, with bursts of up to `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Geocoders are any object with geocode(query) -> (lat, lng) or None, plus the
+# request rate and concurrency the provider allows. Nominatim's usage policy
+# is one request per second from a single client.
+class NominatimGeocoder:
+    name = 'nominatim'
+    rate_limit = 1.0
+    max_concurrency = 1
+
+    def __init__(self, user_agent="fuel_address_locator", timeout=10):
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def geocode(self, query):
+        location = self.geolocator.geocode(query)
+        if location:
+            return location.latitude, location.longitude
+        return None
+
+# Call the geocoder under the rate limiter, retrying transient errors with
+# exponential backoff. Raises the last error once the retries are used up.
+def geocode_with_retry(geocoder, query, limiter, max_retries=GEOCODE_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
         try:
-            location = geolocator.geocode(query)
-            if location:
-                return location.latitude, location.longitude
-            else:
-                return None, None
-        except (GeocoderTimedOut, GeocoderUnavailable):
-            print(f"Retrying for: {query}")
-            time.sleep(1)
-            return get_lat_lng(query)
-
-    # Open output CSV
-    with open(output_csv_file, mode='w', encoding='utf-8', newline='') as output_file:
-        fieldnames = ['Address', 'Latitude', 'Longitude']
-        writer = csv.DictWriter(output_file, fieldnames=fieldnames)
-        writer.writeheader()
+            return geocoder.geocode(query)
+        except RETRYABLE_GEOCODER_ERRORS:
+            if attempt == max_retries:
+                raise
+            delay = 2 ** attempt
+            print(f"Retrying for: {query} in {delay}s")
+            time.sleep(delay)
 
-        # Loop through unique addresses
-        for address, suburb in unique_entries:
-            lat, lng = get_lat_lng(address)
-            
-            if lat is None or lng is None:
-                print(f"Address not found: {address}. Trying suburb: {suburb}")
-                lat, lng = get_lat_lng(suburb)
+# Resolve every unique address: offline against the bundled reference data
+# first, then the geocode cache, and only the leftovers through the network
+# geocoder. The output has a MatchConfidence column (1.0 for exact offline
+# matches, the fuzzy score for approximate ones, empty for network results)
+# and the AddressKey that GEO_MAPPING is keyed by. With merge the input only
+# holds new rows (see main.SKIP_LOADED_ROWS): the rows already in the output
+# are kept and this run's addresses replace those with the same AddressKey.
+# Without network the leftovers are written without coordinates and are not
+# recorded as misses, so a later networked run still geocodes them.
+def geocode_unique_addresses(input_csv_file='cleaned_fuelcheck_data.csv', output_csv_file=GEOCODED_ADDRESSES_OUTPUT,
+                             geocoder=None, cache_path=GEOCODE_CACHE_PATH, max_workers=None, offline=True,
+                             merge=False, network=True):
+    if geocoder is None:
+        geocoder = NominatimGeocoder()
+    provider = getattr(geocoder, 'name', type(geocoder).__name__)
+    rate_limit = getattr(geocoder, 'rate_limit', 1.0)
+    if max_workers is None:
+        max_workers = getattr(geocoder, 'max_concurrency', 1)
+    limiter = TokenBucket(rate_limit, capacity=max_workers)
 
-            if lat and lng:
-                print(f"Location found: {address} -> Lat: {lat}, Lng: {lng}")
+    # Address -> suburb for every unique address in the input. Spelling variants
+    # of one address share an address key and are geocoded once, under the
+    # first variant seen.
+    unique_entries = {}
+    address_keys = {}
+
+    # Extract unique address + suburb pairs from input CSV, reading only those
+    # two columns a chunk at a time
+    for chunk in pd.read_csv(input_csv_file, usecols=['Address', 'Suburb'], dtype=str,
+                             keep_default_na=False, chunksize=200_000):
+        chunk = chunk.drop_duplicates()
+        for address, suburb in zip(chunk['Address'].str.strip(), chunk['Suburb'].str.strip()):
+            key = address_key(address)
+            if key not in address_keys:
+                address_keys[key] = address
+                unique_entries[address] = suburb
+
+    offline_geocoder = OfflineGeocoder() if offline else None
+    cache = GeocodeCache(cache_path)
+    results = {}
+    pending = []
+    for address, suburb in unique_entries.items():
+        if offline_geocoder is not None:
+            location = offline_geocoder.match(address, suburb)
+            if location is not None:
+                results[address] = location
+                continue
+        cached = cache.get(address)
+        if cached is None:
+            pending.append((address, suburb))
+        else:
+            results[address] = (cached[0], cached[1], None)
+    if not network:
+        print(f"{len(results)} addresses resolved offline or from the geocode cache, "
+              f"{len(pending)} left ungeocoded (network geocoding is off)")
+        pending = []
+    else:
+        print(f"{len(results)} addresses resolved offline or from the geocode cache, {len(pending)} to geocode with {provider}")
+
+    # Try the address first (its GNAF form when the station register knows it),
+    # then fall back to the suburb
+    def locate(address, suburb):
+        query = address
+        if offline_geocoder is not None:
+            query = offline_geocoder.canonical_query(address, suburb) or address
+        location = geocode_with_retry(geocoder, query, limiter)
+        if location is None and suburb:
+            print(f"Address not found: {address}. Trying suburb: {suburb}")
+            location = geocode_with_retry(geocoder, suburb, limiter)
+        return query, location
+
+    # Results are written to the cache as they arrive, so an interrupted run
+    # only repeats the addresses that were still in flight
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(locate, address, suburb): address for address, suburb in pending}
+        for future in as_completed(futures):
+            address = futures[future]
+            try:
+                query, location = future.result()
+            except RETRYABLE_GEOCODER_ERRORS as e:
+                print(f"Giving up on {address} for this run: {e}")
+                continue
+
+            if location:
+                print(f"Location found: {address} -> Lat: {location[0]}, Lng: {location[1]}")
+                cache.put(address, query, location[0], location[1], provider)
             else:
                 print(f"Could not find location for Address or Suburb: {address}")
+                cache.put(address, query, None, None, provider)
+                location = (None, None)
+            results[address] = (location[0], location[1], None)
+    cache.close()
 
-            writer.writerow({'Address': address, 'Latitude': lat, 'Longitude': lng})
+    fieldnames = ['AddressKey', 'Address', 'Latitude', 'Longitude', 'MatchConfidence']
+    kept_rows = []
+    if merge and os.path.exists(output_csv_file):
+        new_keys = {str(key) for key in address_keys}
+        with open(output_csv_file, encoding='utf-8', newline='') as existing_file:
+            kept_rows = [row for row in csv.DictReader(existing_file) if row.get('AddressKey') not in new_keys]
+        print(f"Keeping {len(kept_rows)} addresses geocoded by earlier runs")
 
-            # Respect rate limit
-            time.sleep(1)
+    # Replace the output CSV
+    os.makedirs(os.path.dirname(output_csv_file) or '.', exist_ok=True)
+    tmp_file = output_csv_file + '.tmp'
+    with open(tmp_file, mode='w', encoding='utf-8', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(kept_rows)
+        for key, address in address_keys.items():
+            lat, lng, confidence = results.get(address, (None, None, None))
+            writer.writerow({'AddressKey': key, 'Address': address, 'Latitude': lat, 'Longitude': lng,
+                             'MatchConfidence': confidence})
+    os.replace(tmp_file, output_csv_file)
 
     print(f"Geocoding complete! Results saved to {output_csv_file}")
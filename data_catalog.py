@@ -0,0 +1,121 @@
+import json
+import os
+import re
+from datetime import datetime
+import requests
+
+# CKAN metadata of the FuelCheck dataset: one request lists every resource
+# with its URL, size and modification time
+CKAN_PACKAGE_URL = "https://data.nsw.gov.au/data/api/3/action/package_show?id=fuel-check"
+# A saved package_show response (see record_catalog_fixture) to use instead of
+# the live catalog, e.g. for offline runs. Its resources may point at local
+# files with file:// URLs (relative ones resolve against the working
+# directory); fixtures/package_show.json is a small one for the repository.
+CATALOG_FIXTURE = os.environ.get('FUELCHECK_CATALOG_FIXTURE')
+MONTHLY_FILE_FORMATS = ['csv', 'xls', 'xlsx']
+
+MONTH_NUMBERS = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+# A month name or abbreviation followed by a 4- or 2-digit year, e.g.
+# 'jan2024', 'January 2024', 'mar-25', 'sept_2024'. Only real month names
+# match, so words such as 'decommissioned_2024' name no month.
+PERIOD_PATTERN = re.compile(
+    r'(?<![a-z])(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?'
+    r'|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)[\s_\-]*((?:19|20)\d{2}|\d{2})(?!\d)'
+)
+
+# (year, month) named in a resource name or file name, or None
+def parse_resource_period(text):
+    if not isinstance(text, str):
+        return None
+    match = PERIOD_PATTERN.search(os.path.basename(text.rstrip('/')).lower())
+    if match is None:
+        return None
+    year = int(match.group(2))
+    return (year if year >= 100 else 2000 + year), MONTH_NUMBERS[match.group(1)[:3]]
+
+def _parse_period_bound(value):
+    if value is None or isinstance(value, tuple):
+        return value
+    year, month = str(value).split('-')[:2]
+    return int(year), int(month)
+
+def fetch_catalog(session=None, fixture=CATALOG_FIXTURE, url=CKAN_PACKAGE_URL):
+    if fixture:
+        with open(fixture, encoding='utf-8') as f:
+            package = json.load(f)
+    else:
+        response = (session or requests).get(url, timeout=60)
+        response.raise_for_status()
+        package = response.json()
+    # package_show wraps the package in {'success': ..., 'result': ...}
+    return package.get('result', package)
+
+# Save the live package_show response as a fixture for offline runs
+def record_catalog_fixture(path, session=None, url=CKAN_PACKAGE_URL):
+    response = (session or requests).get(url, timeout=60)
+    response.raise_for_status()
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(response.json(), f, indent=2)
+    os.replace(tmp_file, path)
+    return path
+
+# Monthly price files in the catalog between start and end (inclusive 'YYYY-MM'
+# strings or (year, month) pairs; None leaves that side open), oldest first.
+# A resource counts as monthly when its format is one of MONTHLY_FILE_FORMATS
+# and its name or URL names a month.
+def discover_monthly_resources(start=None, end=None, session=None, fixture=CATALOG_FIXTURE):
+    start, end = _parse_period_bound(start), _parse_period_bound(end)
+    package = fetch_catalog(session, fixture)
+
+    entries = {}
+    for resource in package.get('resources', []):
+        url = resource.get('url') or ''
+        file_format = (resource.get('format') or url.rsplit('.', 1)[-1]).lower()
+        if file_format not in MONTHLY_FILE_FORMATS:
+            continue
+        period = parse_resource_period(url) or parse_resource_period(resource.get('name'))
+        if period is None or (start and period < start) or (end and period > end):
+            continue
+        entries[url] = {
+            'url': url,
+            'name': resource.get('name'),
+            'period': f"{period[0]}-{period[1]:02d}",
+            'format': file_format,
+            'size': resource.get('size'),
+            'last_modified': resource.get('last_modified') or resource.get('metadata_modified'),
+        }
+    return sorted(entries.values(), key=lambda entry: (entry['period'], entry['url']))
+
+def load_catalog_manifest(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('resources', [])
+
+def save_catalog_manifest(path, entries):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'discovered_at': datetime.now().isoformat(timespec='seconds'), 'resources': entries}, f, indent=2)
+    os.replace(tmp_file, path)
+
+# Compare two manifests by URL: resources that are new, whose size or
+# modification time changed, that are unchanged, or that disappeared
+def diff_catalog_manifests(previous, current):
+    previous_by_url = {entry['url']: entry for entry in previous}
+    current_urls = {entry['url'] for entry in current}
+    diff = {'new': [], 'changed': [], 'unchanged': [], 'removed': []}
+    for entry in current:
+        before = previous_by_url.get(entry['url'])
+        if before is None:
+            diff['new'].append(entry)
+        elif (before.get('size'), before.get('last_modified')) != (entry.get('size'), entry.get('last_modified')):
+            diff['changed'].append(entry)
+        else:
+            diff['unchanged'].append(entry)
+    diff['removed'] = [entry for entry in previous if entry['url'] not in current_urls]
+    return diff
@@ -0,0 +1,147 @@
+import duckdb
+import pandas as pd
+from datetime import datetime
+from typing import Optional
+from data_analytics import DB_PATH
+
+def create_price_history_tables(con):
+    # Latest update of every (station, fuel): what the price is now
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS current_prices (
+            station_id INTEGER,
+            fuel_id SMALLINT,
+            station_tracking_id INTEGER,
+            priceupdateddate TIMESTAMP,
+            price FLOAT,
+            PRIMARY KEY (station_id, fuel_id)
+        );
+    """)
+    # Run-length compressed price changes: one row per run of updates with the
+    # same price, valid from its first update until the next run starts
+    # (valid_to is NULL for the run still in force). Consecutive updates that
+    # repeat the price add no rows. Rows without a fuel code are left out.
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS price_history (
+            station_id INTEGER,
+            fuel_id SMALLINT,
+            valid_from TIMESTAMP,
+            valid_to TIMESTAMP,
+            price FLOAT,
+            PRIMARY KEY (station_id, fuel_id, valid_from)
+        );
+    """)
+
+# Bring current_prices and price_history up to date with fuel_prices. since is
+# the earliest timestamp whose fact rows changed (the first reloaded month);
+# only (station, fuel) pairs with rows from then on are recomputed, and their
+# history before since is kept. since=None rebuilds both tables. Meant to run
+# inside the load transaction.
+def refresh_price_history(con, since=None):
+    create_price_history_tables(con)
+    if since is None:
+        con.execute("DELETE FROM current_prices")
+        con.execute("DELETE FROM price_history")
+        since = datetime.min
+
+    # Pairs whose current price may have moved: rows from since on, or a
+    # current price from since on (its row may have been deleted)
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE touched_pairs AS
+        SELECT DISTINCT station_id, fuel_id FROM fuel_prices WHERE priceupdateddate >= ? AND fuel_id IS NOT NULL
+        UNION
+        SELECT station_id, fuel_id FROM current_prices WHERE priceupdateddate >= ?
+    """, [since, since])
+    con.execute("""
+        DELETE FROM current_prices
+        WHERE (station_id, fuel_id) IN (SELECT station_id, fuel_id FROM touched_pairs)
+    """)
+    con.execute("""
+        INSERT INTO current_prices
+        SELECT p.station_id, p.fuel_id, p.station_tracking_id, p.priceupdateddate, p.price
+        FROM fuel_prices p
+        SEMI JOIN touched_pairs t ON t.station_id = p.station_id AND t.fuel_id = p.fuel_id
+        QUALIFY row_number() OVER (
+            PARTITION BY p.station_id, p.fuel_id
+            ORDER BY p.priceupdateddate DESC, p.station_tracking_id DESC
+        ) = 1
+    """)
+
+    # History from since on is rebuilt from the fact rows, starting from the
+    # run that was in force at since so an unchanged price extends it
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE history_points AS
+        SELECT station_id, fuel_id, valid_from AS changed_at, price, 0 AS point_order
+        FROM price_history
+        WHERE valid_from < ? AND (valid_to IS NULL OR valid_to >= ?)
+        UNION ALL
+        SELECT station_id, fuel_id, priceupdateddate, price, station_tracking_id
+        FROM fuel_prices
+        WHERE priceupdateddate >= ? AND fuel_id IS NOT NULL
+    """, [since, since, since])
+    con.execute("""
+        DELETE FROM price_history
+        WHERE valid_from >= ? OR valid_to IS NULL OR valid_to >= ?
+    """, [since, since])
+    # Two updates in the same second keep the later-loaded one
+    con.execute("""
+        INSERT INTO price_history
+        SELECT station_id, fuel_id, changed_at,
+               lead(changed_at) OVER (PARTITION BY station_id, fuel_id ORDER BY changed_at),
+               price
+        FROM (
+            SELECT *, lag(price) OVER (PARTITION BY station_id, fuel_id ORDER BY changed_at) AS previous_price
+            FROM (
+                SELECT * FROM history_points
+                QUALIFY row_number() OVER (
+                    PARTITION BY station_id, fuel_id, changed_at ORDER BY point_order DESC
+                ) = 1
+            )
+        )
+        WHERE previous_price IS NULL OR previous_price <> price
+        ORDER BY station_id, fuel_id, changed_at
+    """)
+    con.execute("DROP TABLE touched_pairs")
+    con.execute("DROP TABLE history_points")
+
+# Price of one fuel at one station at a point in time (None before its first
+# update). Served from the change history, not the fact table.
+def price_at(station_id: int, fuelcode: str, at, db_path: str = DB_PATH) -> Optional[float]:
+    con = duckdb.connect(db_path, read_only=True)
+    try:
+        row = con.execute("""
+            SELECT h.price
+            FROM price_history h
+            JOIN fuel_codes f ON f.fuel_id = h.fuel_id
+            WHERE h.station_id = ? AND f.fuelcode = ? AND h.valid_from <= ?
+            ORDER BY h.valid_from DESC
+            LIMIT 1
+        """, [station_id, fuelcode, pd.Timestamp(at).to_pydatetime()]).fetchone()
+    finally:
+        con.close()
+    return None if row is None else row[0]
+
+# Prices for a batch of lookups in one ASOF join. queries has station_id,
+# fuelcode and at columns; the result adds price and price_since (the start of
+# the run in force at `at`), NULL where the station had no price yet. Rows come
+# back in the order of queries.
+def prices_as_of(queries: pd.DataFrame, db_path: str = DB_PATH) -> pd.DataFrame:
+    lookups = queries[['station_id', 'fuelcode', 'at']].copy()
+    lookups['at'] = pd.to_datetime(lookups['at'])
+    lookups['query_order'] = range(len(lookups))
+    con = duckdb.connect(db_path, read_only=True)
+    try:
+        con.register('price_lookups', lookups)
+        result = con.execute("""
+            SELECT q.station_id, q.fuelcode, q.at, h.price, h.valid_from AS price_since
+            FROM (
+                SELECT l.*, f.fuel_id
+                FROM price_lookups l
+                LEFT JOIN fuel_codes f ON f.fuelcode = l.fuelcode
+            ) q
+            ASOF LEFT JOIN price_history h
+              ON h.station_id = q.station_id AND h.fuel_id = q.fuel_id AND q.at >= h.valid_from
+            ORDER BY q.query_order
+        """).fetchdf()
+    finally:
+        con.close()
+    return result
@@ -1,164 +1,410 @@
 # Import necessary libraries 
 import pandas as pd
+import numpy as np
 from datetime import datetime
-import random
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import inspect
+import json
+import os
+import sys
+import pyarrow as pa
+import pyarrow.parquet as pq
+import data_addresses
+import data_retrieval
+import data_validation
+from data_retrieval import load_monthly_file, iter_monthly_file_chunks, source_file_column, make_arrow_safe, concat_fuelcheck_frames, STREAM_CHUNK_SIZE
+from data_addresses import address_keys
+from data_catalog import parse_resource_period
+from data_validation import validate, quarantine_rows
+from metrics import verbose
 
-def data_cleaning(fuelcheck_raw_data):
+# Seed for the time of day given to backfilled dates (hash keys are 16 bytes)
+DATE_FILL_SEED = 'fuelcheck-dates-'
+# Fixed timestamp format so chunked and whole-frame exports are identical
+CSV_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Low-cardinality text columns handed to Arrow/Parquet as dictionaries
+DICTIONARY_COLUMNS = ['ServiceStationName', 'Address', 'Suburb', 'Brand', 'FuelCode', 'source_file']
+# Business key of a price row (a station's price for one fuel at one time).
+# Rows with the same key are duplicates whichever monthly file they came from.
+DEDUP_KEY = [col for col in os.environ.get(
+    'DEDUP_KEY', 'ServiceStationName,Address,FuelCode,PriceUpdatedDate,Price').split(',') if col]
+# Seed for the business-key hashes (hash keys are 16 bytes)
+ROW_KEY_SEED = 'fuelcheck-rowkey'
+# Key hashes of the rows loaded into DuckDB, kept by store_to_duckdb
+SEEN_KEYS_PATH = 'db/seen_row_keys.npy'
+# Parquet metadata key of a cleaned output: the monthly files it was cleaned
+# from and the cleaning code version (see split_changed_files)
+CLEANED_FILES_METADATA = b'fuelcheck_cleaned_files'
+
+# seen_keys (a SeenKeys) drops rows whose business key was already loaded.
+# Rows failing validation are appended to quarantine (a list) when given, see
+# data_validation.save_quarantine.
+def data_cleaning(fuelcheck_raw_data, seen_keys=None, quarantine=None):
+    fuelcheck_raw_data = clean_partition(fuelcheck_raw_data, quarantine)
+    return finalize_cleaning(fuelcheck_raw_data, seen_keys)
+
+# Row-local cleaning steps, safe to run on each month independently. The rows
+# failing validation go to quarantine (a list of frames) when given.
+def clean_partition(fuelcheck_raw_data, quarantine=None):
     # Drop fully empty rows
     print("Rows before dropping empty rows:", len(fuelcheck_raw_data))
     fuelcheck_raw_data.dropna(how='all', inplace=True)
     print("Rows after dropping empty rows:", len(fuelcheck_raw_data))
 
-    # Drop duplicate rows  
-    print("Rows before dropping duplicates:", len(fuelcheck_raw_data))
-    fuelcheck_raw_data.drop_duplicates(inplace=True)
-    print("Rows after dropping duplicates:", len(fuelcheck_raw_data))
-
-    # Strip leading/trailing spaces in all text columns
+    # Strip leading/trailing spaces in all text columns. Categorical columns are
+    # stripped once per category rather than once per row.
     str_columns = fuelcheck_raw_data.select_dtypes(include='object').columns
+    category_columns = fuelcheck_raw_data.select_dtypes(include='category').columns
     print("Stripping whitespace from the following string columns:")
-    print(str_columns.tolist())
+    print(str_columns.tolist() + category_columns.tolist())
 
     fuelcheck_raw_data[str_columns] = fuelcheck_raw_data[str_columns].apply(lambda col: col.str.strip())
+    for col in category_columns:
+        fuelcheck_raw_data[col] = strip_categories(fuelcheck_raw_data[col])
     print("Whitespace removed.")
 
-    # PriceUpdatedDate column quality check
-    null_count = fuelcheck_raw_data['PriceUpdatedDate'].isnull().sum()
-    blank_count = fuelcheck_raw_data['PriceUpdatedDate'].astype(str).str.strip().eq('').sum()
-    invalid_values = ['--', '-', 'null', 'n/a', 'na', '0', 0]
-    invalid_count = fuelcheck_raw_data['PriceUpdatedDate'].astype(str).str.lower().isin(invalid_values).sum()
-    total_bad = null_count + blank_count + invalid_count
-
-    print(f"PriceUpdatedDate column quality check:")
-    print(f"Null values: {null_count}")
-    print(f"Blank strings: {blank_count}")
-    print(f"Common invalid entries: {invalid_count}")
-    print(f"Total problematic entries: {total_bad}")
-
-    bad_rows = fuelcheck_raw_data[
-        fuelcheck_raw_data['PriceUpdatedDate'].isnull() |
-        fuelcheck_raw_data['PriceUpdatedDate'].astype(str).str.strip().isin(['', '--', '-', 'null', 'n/a', 'na', '0'])
-    ]
-    print(bad_rows[['PriceUpdatedDate', 'source_file']].head(10))
-
-    # Convert Price column to numeric and remove outliers
-    if 'Price' in fuelcheck_raw_data.columns:
-        print("Filtering out prices outside 50–300 cents range")
-        before_rows = len(fuelcheck_raw_data)
-        fuelcheck_raw_data = fuelcheck_raw_data[
-            (fuelcheck_raw_data['Price'] >= 50) & (fuelcheck_raw_data['Price'] <= 300)
-        ]
-        after_rows = len(fuelcheck_raw_data)
-        print(f"Filtered out {before_rows - after_rows} rows with invalid prices.")
-    else:
-        print("'Price' column not found in dataset.")
+    # Stable key of the canonical address, so spelling variants of one site
+    # join to the same GEO_MAPPING row
+    if 'Address' in fuelcheck_raw_data.columns:
+        fuelcheck_raw_data['AddressKey'] = address_keys(fuelcheck_raw_data['Address'])
 
     # Fill missing PriceUpdatedDate using source_file name
-    print("Remaining nulls in 'PriceUpdatedDate':", fuelcheck_raw_data['PriceUpdatedDate'].isnull().sum())
     if 'PriceUpdatedDate' in fuelcheck_raw_data.columns and 'source_file' in fuelcheck_raw_data.columns:
-        null_count = fuelcheck_raw_data['PriceUpdatedDate'].isnull().sum()
-        print(f"Filling {null_count} missing dates using file name")
+        date_values = fuelcheck_raw_data['PriceUpdatedDate']
+        missing_dates = date_values.isnull()
+        if date_values.dtype == object:
+            missing_dates |= date_values.eq('')
+        print(f"Filling {missing_dates.sum()} missing dates using file name")
 
-        fuelcheck_raw_data['PriceUpdatedDate'] = fuelcheck_raw_data.apply(
-            lambda row: row['PriceUpdatedDate'] if (pd.notnull(row['PriceUpdatedDate']) and str(row['PriceUpdatedDate']).strip() != '') 
-            else infer_date_from_filename(row['source_file']),
-            axis=1
-        )
-
-        print("Remaining nulls in 'PriceUpdatedDate':", fuelcheck_raw_data['PriceUpdatedDate'].isnull().sum())
+        if missing_dates.any():
+            # Parse the month once per source file, then map it onto the missing rows only
+            missing_rows = fuelcheck_raw_data.loc[missing_dates]
+            month_starts = {
+                source_file: infer_date_from_filename(source_file)
+                for source_file in missing_rows['source_file'].dropna().unique()
+            }
+            fill_dates = pd.to_datetime(missing_rows['source_file'].astype(object).map(month_starts))
+            fuelcheck_raw_data.loc[missing_dates, 'PriceUpdatedDate'] = fill_dates + time_of_day_jitter(missing_rows)
     else:
         print("Required columns for date fill not found.")
 
-    # Convert PriceUpdatedDate to datetime format
-    if 'PriceUpdatedDate' in fuelcheck_raw_data.columns:
-        print("Converting 'PriceUpdatedDate' to datetime")
-        fuelcheck_raw_data['PriceUpdatedDate'] = pd.to_datetime(
-            fuelcheck_raw_data['PriceUpdatedDate'], errors='coerce'
+    # Validate every rule in one pass per column (see data_validation); rows
+    # failing a rule are set aside with their reasons instead of dropped
+    result = validate(fuelcheck_raw_data)
+    for name, count in result.counts.items():
+        if count:
+            print(f"Rule {name}: {count} rows")
+    if quarantine is not None and result.rejected.any():
+        quarantine.append(quarantine_rows(fuelcheck_raw_data, result))
+    print(f"Rejected {int(result.rejected.sum())} rows. ", end="")
+    fuelcheck_raw_data = fuelcheck_raw_data[~result.rejected]
+
+    # Dates were parsed once by the date rules
+    if 'PriceUpdatedDate' in result.parsed:
+        fuelcheck_raw_data = fuelcheck_raw_data.assign(
+            PriceUpdatedDate=result.parsed['PriceUpdatedDate'][~result.rejected].astype('datetime64[s]')
         )
-        print("Nulls in 'PriceUpdatedDate' after conversion:", fuelcheck_raw_data['PriceUpdatedDate'].isnull().sum())
-    else:
-        print("'PriceUpdatedDate' column not found in dataset.")
+    print(f"Dataset shape: {fuelcheck_raw_data.shape}")
 
-    # Drop rows missing any of the key fields
-    required_fields = ['ServiceStationName', 'PriceUpdatedDate', 'Price']
-    print("Dropping rows with missing values in required fields:", required_fields)
-    before_drop = len(fuelcheck_raw_data)
+    # Drop rows repeating a business key; done last so the key columns are
+    # already stripped and typed
+    print("Rows before dropping duplicates:", len(fuelcheck_raw_data))
+    fuelcheck_raw_data = drop_duplicate_keys(fuelcheck_raw_data)
+    print("Rows after dropping duplicates:", len(fuelcheck_raw_data))
 
-    fuelcheck_raw_data.dropna(
-        subset=[col for col in required_fields if col in fuelcheck_raw_data.columns],
-        inplace=True
-    )
+    return fuelcheck_raw_data
+
+# Strip a categorical column through its categories; categories that become
+# equal after stripping (' BP' and 'BP') are merged
+def strip_categories(column):
+    stripped = column.cat.categories.str.strip()
+    if stripped.equals(column.cat.categories):
+        return column
+    new_codes, new_categories = pd.factorize(stripped)
+    codes = column.cat.codes.to_numpy()
+    codes = pd.Series(new_codes[codes], index=column.index).where(codes >= 0, -1).to_numpy()
+    return pd.Series(pd.Categorical.from_codes(codes, categories=new_categories), index=column.index, name=column.name)
+
+# 64-bit hash of each row's business key. The key columns are brought to one
+# representation first (dates to the second, prices to 1/1000 cent), so the
+# hash of a row is the same whether it comes from a fresh frame, the cleaned
+# Parquet or the cleaned CSV.
+def row_key_hashes(df, key=None):
+    key_frame = {}
+    for col in key or DEDUP_KEY:
+        values = df[col]
+        if col == 'PriceUpdatedDate':
+            values = pd.to_datetime(values, errors='coerce').astype('datetime64[s]')
+        elif col == 'Price':
+            values = (pd.to_numeric(values, errors='coerce').astype('float64') * 1000).round().astype('Int64')
+        key_frame[col] = values.reset_index(drop=True)
+    return pd.util.hash_pandas_object(pd.DataFrame(key_frame), index=False, hash_key=ROW_KEY_SEED).to_numpy()
+
+# Keep the first row of every business key, and none whose key is in seen_keys
+def drop_duplicate_keys(fuelcheck_raw_data, seen_keys=None):
+    hashes = row_key_hashes(fuelcheck_raw_data)
+    keep = ~pd.Series(hashes).duplicated().to_numpy()
+    if seen_keys is not None:
+        keep &= ~seen_keys.contains(hashes)
+    return fuelcheck_raw_data[keep]
+
+# Set of 64-bit row-key hashes as sorted NumPy runs, saved as one .npy file.
+# New keys are added as a sorted run and runs of similar size are merged, so
+# adding a chunk costs about its own size and lookups are binary searches.
+class SeenKeys:
+    def __init__(self, path=None):
+        self.runs = []
+        if path and os.path.exists(path):
+            self.runs.append(np.load(path))
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            if len(run):
+                positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+                found |= run[positions] == hashes
+        return found
+
+    def add(self, hashes):
+        self.runs.append(np.unique(np.asarray(hashes, dtype=np.uint64)))
+        while len(self.runs) > 1 and len(self.runs[-1]) * 2 >= len(self.runs[-2]):
+            merged = np.union1d(self.runs.pop(), self.runs.pop())
+            self.runs.append(merged)
 
-    after_drop = len(fuelcheck_raw_data)
-    print(f"Dropped {before_drop - after_drop} rows. Final dataset shape: {fuelcheck_raw_data.shape}")
+    def save(self, path=SEEN_KEYS_PATH):
+        keys = np.unique(np.concatenate(self.runs)) if self.runs else np.empty(0, dtype=np.uint64)
+        self.runs = [keys]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, keys)
+        os.replace(tmp_file, path)
+
+# Cross-partition steps, run once over the combined cleaned months
+def finalize_cleaning(fuelcheck_raw_data, seen_keys=None):
+    print("Rows before dropping cross-month duplicates:", len(fuelcheck_raw_data))
+    fuelcheck_raw_data = drop_duplicate_keys(fuelcheck_raw_data, seen_keys).reset_index(drop=True)
+    print("Rows after dropping cross-month duplicates:", len(fuelcheck_raw_data))
 
     # Dataset summary
     print("Shape (rows, columns):", fuelcheck_raw_data.shape)
-    print("\nRemaining nulls per column:")
-    print(fuelcheck_raw_data.isnull().sum())
-    print("\nColumn data types:")
-    print(fuelcheck_raw_data.dtypes)
-    print("\nPrice column summary:")
-    print(fuelcheck_raw_data['Price'].describe())
+    if verbose(2):
+        print("\nRemaining nulls per column:")
+        print(fuelcheck_raw_data.isnull().sum())
+        print("\nColumn data types:")
+        print(fuelcheck_raw_data.dtypes)
+        print("\nPrice column summary:")
+        print(fuelcheck_raw_data['Price'].describe())
 
-    if 'FuelCode' in fuelcheck_raw_data.columns:
-        print("\nUnique Fuel Types:")
-        print(fuelcheck_raw_data['FuelCode'].value_counts())
+        if 'FuelCode' in fuelcheck_raw_data.columns:
+            print("\nUnique Fuel Types:")
+            print(fuelcheck_raw_data['FuelCode'].value_counts())
 
-    print("\nSample rows:")
-    print(fuelcheck_raw_data.sample(5, random_state=42))
-    print("NULL:", fuelcheck_raw_data.isna().sum())
+        print("\nSample rows:")
+        print(fuelcheck_raw_data.sample(min(5, len(fuelcheck_raw_data)), random_state=42))
 
     return fuelcheck_raw_data
 
-# Extract months from source link to apply default date to null values
+# Worker for the process pool: parse one month and run the row-local cleaning
+# on it. Returns the cleaned month and its rejected rows.
+def _load_and_clean_month(monthly_file):
+    file_link, local_path = monthly_file
+    try:
+        df_month = load_monthly_file(local_path)
+    except Exception as e:
+        print(f"Failed to load {file_link}: {e}")
+        return None, []
+    if df_month is None:
+        return None, []
+    df_month['source_file'] = source_file_column(file_link, len(df_month))
+    rejected = []
+    return clean_partition(df_month, rejected), rejected
+
+# Parse and clean each month in its own process, then deduplicate across months
+def clean_monthly_files_parallel(monthly_files, max_workers=4, seen_keys=None, quarantine=None):
+    print(f"Cleaning {len(monthly_files)} monthly files with {max_workers} workers")
+    cleaned_months = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for monthly_file, (df_month, rejected) in zip(monthly_files,
+                                                      executor.map(_load_and_clean_month, monthly_files)):
+            if quarantine is not None:
+                quarantine.extend(rejected)
+            if df_month is None:
+                print(f"Skipping file: {monthly_file[1]}")
+                continue
+            cleaned_months.append(df_month)
+
+    if not cleaned_months:
+        print("No data loaded.")
+        return pd.DataFrame()
+
+    combined_df = concat_fuelcheck_frames(cleaned_months)
+    return finalize_cleaning(combined_df, seen_keys)
+
+# Extract the month from the source link to apply a default date to null values
 def infer_date_from_filename(filename):
-    month_map = {
-        'jan': 1, 'january': 1,
-        'feb': 2, 'february': 2,
-        'mar': 3, 'march': 3,
-        'apr': 4, 'april': 4,
-        'may': 5,
-        'jun': 6, 'june': 6,
-        'jul': 7, 'july': 7,
-        'aug': 8, 'august': 8,
-        'sep': 9, 'september': 9,
-        'oct': 10, 'october': 10,
-        'nov': 11, 'november': 11,
-        'dec': 12, 'december': 12
-    }
-
-    if not isinstance(filename, str):
+    period = parse_resource_period(filename)
+    if period is None:
         return pd.NaT
-    filename = filename.lower().replace('-', '').replace('_', '')
-
-    for key, month in month_map.items():
-        if key in filename:
-            if '2024' in filename:
-                base_date = datetime(2024, month, 1)
-            elif '2025' in filename or '25' in filename:
-                base_date = datetime(2025, month, 1)
-            else:
-                return pd.NaT
-
-            # ADD RANDOM HOURS, MINUTES, SECONDS
-            random_hours = random.randint(0, 23)
-            random_minutes = random.randint(0, 59)
-            random_seconds = random.randint(0, 59)
-
-            final_date = base_date.replace(
-                hour=random_hours, 
-                minute=random_minutes, 
-                second=random_seconds
-            )
-            return final_date
-    return pd.NaT
+    return datetime(period[0], period[1], 1)
+
+# Deterministic time of day for backfilled dates: a seeded 64-bit hash of each
+# row's other values, so reruns (serial or per-month) give identical output
+def time_of_day_jitter(rows):
+    row_hashes = pd.util.hash_pandas_object(
+        jitter_values(rows.drop(columns=['PriceUpdatedDate'])), index=False, hash_key=DATE_FILL_SEED
+    )
+    return pd.to_timedelta((row_hashes.to_numpy() % 86400).astype('int64'), unit='s')
+
+# The values hashed by time_of_day_jitter in the types the monthly files were
+# read with before the compact schema (text as objects, numbers as float64), so
+# the backfilled times stored in fuel_prices do not depend on the dtypes
+def jitter_values(rows):
+    rows = rows.copy()
+    for col in rows.columns:
+        dtype = rows[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(dtype):
+            rows[col] = rows[col].astype(object)
+        elif dtype == np.float32:
+            # Through text, so a price of 181.9 hashes as 181.9 and not as its float32 neighbour
+            rows[col] = pd.to_numeric(rows[col].astype(str), errors='coerce')
+        elif col == 'Postcode':
+            # UInt16 in the compact schema; read as float64 since a month has missing postcodes
+            rows[col] = rows[col].astype('float64')
+    return rows
 
 # Convert cleaned data to CSV
 def convert_cleaned_data_to_csv(fuelcheck_raw_data):
     output_file = "cleaned_fuelcheck_data.csv"
     fuelcheck_raw_data = fuelcheck_raw_data.drop(columns=["source_file"])
-    print(fuelcheck_raw_data.head())
-    print("NULL:", fuelcheck_raw_data.isna().sum())
-    fuelcheck_raw_data.to_csv(output_file, index=False)
-    print(f"Converted Cleaned data saved to {output_file}")
\ No newline at end of file
+    if verbose(2):
+        print(fuelcheck_raw_data.head())
+        print("NULL:", fuelcheck_raw_data.isna().sum())
+    fuelcheck_raw_data.to_csv(output_file, index=False, date_format=CSV_DATE_FORMAT)
+    print(f"Converted Cleaned data saved to {output_file}")
+
+# Streaming mode: read each month in chunks, clean every chunk and append it to
+# the cleaned CSV, so memory is bounded by the chunk size instead of the dataset.
+# The business-key hashes of the rows written so far are kept for the whole run
+# (8 bytes per row), so duplicates are dropped across chunks and months, and
+# seen_keys drops rows that were already loaded. Rejected rows are appended to
+# quarantine when given.
+def stream_clean_to_csv(monthly_files, output_file="cleaned_fuelcheck_data.csv", chunksize=STREAM_CHUNK_SIZE,
+                        seen_keys=None, quarantine=None):
+    tmp_file = output_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    total_rows = 0
+    write_header = True
+    written_keys = SeenKeys()
+    for file_link, local_path in monthly_files:
+        for chunk in iter_monthly_file_chunks(local_path, chunksize):
+            chunk['source_file'] = source_file_column(file_link, len(chunk))
+            chunk = clean_partition(chunk, quarantine)
+
+            row_hashes = row_key_hashes(chunk)
+            keep = ~written_keys.contains(row_hashes)
+            if seen_keys is not None:
+                keep &= ~seen_keys.contains(row_hashes)
+            written_keys.add(row_hashes[keep])
+
+            chunk = chunk[keep].drop(columns=["source_file"])
+            chunk.to_csv(tmp_file, mode='a', header=write_header, index=False, date_format=CSV_DATE_FORMAT)
+            write_header = False
+            total_rows += len(chunk)
+
+    # Only replace the previous output once the whole run has succeeded
+    if os.path.exists(tmp_file):
+        os.replace(tmp_file, output_file)
+    print(f"Streamed {total_rows} cleaned rows to {output_file}")
+    return output_file
+
+# Cleaned data as an Arrow table with the repetitive text columns dictionary-encoded,
+# so DuckDB and Parquet get compact columns instead of Python string objects
+def cleaned_frame_to_arrow(fuelcheck_raw_data):
+    try:
+        table = pa.Table.from_pandas(fuelcheck_raw_data, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        table = pa.Table.from_pandas(make_arrow_safe(fuelcheck_raw_data.copy()), preserve_index=False)
+
+    for col in DICTIONARY_COLUMNS:
+        if col not in table.column_names:
+            continue
+        index = table.column_names.index(col)
+        column_type = table.column(col).type
+        # A column without any text (e.g. an empty frame) comes out typed null
+        if pa.types.is_null(column_type) or (pa.types.is_dictionary(column_type)
+                                             and pa.types.is_null(column_type.value_type)):
+            table = table.set_column(index, col, pa.nulls(table.num_rows, pa.string()))
+        if not pa.types.is_dictionary(table.column(col).type):
+            table = table.set_column(index, col, table.column(col).dictionary_encode())
+    return table
+
+# Convert cleaned data to Parquet (keeps source_file for the DuckDB load manifest).
+# monthly_files, the [(link, path)] list the rows were cleaned from, is recorded
+# in the file's metadata for changed-only cleaning.
+def convert_cleaned_data_to_parquet(fuelcheck_raw_data, output_file="cleaned_fuelcheck_data.parquet",
+                                    monthly_files=None):
+    tmp_file = output_file + '.tmp'
+    table = cleaned_frame_to_arrow(fuelcheck_raw_data)
+    if monthly_files is not None:
+        record = {'files': [file_link for file_link, _ in monthly_files], 'code': cleaning_code_version()}
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               CLEANED_FILES_METADATA: json.dumps(record).encode('utf-8')})
+    pq.write_table(table, tmp_file)
+    os.replace(tmp_file, output_file)
+    print(f"Converted Cleaned data saved to {output_file}")
+    return output_file
+
+# Version of the code that shapes the cleaned rows (the source of the modules
+# used for parsing, validating and cleaning); cleaned rows recorded under
+# another version are not reused
+def cleaning_code_version():
+    digest = hashlib.sha256()
+    for module in [data_retrieval, data_addresses, data_validation, sys.modules[__name__]]:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+# Changed-only cleaning: the monthly files to clean again. A file is cleaned
+# again when the retrieval reports it changed (changed_files) or the earlier
+# cleaned output does not include it; the rows of the other files can be kept
+# (read_cleaned_rows). None when there is no earlier output or it was cleaned
+# by other code: every file has to be cleaned.
+def split_changed_files(cleaned_file, monthly_files, changed_files):
+    record = None
+    if os.path.exists(cleaned_file):
+        metadata = pq.read_schema(cleaned_file).metadata or {}
+        if CLEANED_FILES_METADATA in metadata:
+            record = json.loads(metadata[CLEANED_FILES_METADATA])
+    if record is None or record.get('code') != cleaning_code_version():
+        return None
+    changed_links = {file_link for file_link, _ in changed_files}
+    cleaned_links = set(record['files'])
+    return [(file_link, local_path) for file_link, local_path in monthly_files
+            if file_link in changed_links or file_link not in cleaned_links]
+
+# Rows of an earlier cleaned output that came from the given monthly file
+# links (none: an empty frame with the output's columns)
+def read_cleaned_rows(cleaned_file, file_links):
+    if not file_links:
+        return pq.read_schema(cleaned_file).empty_table().to_pandas()
+    return pd.read_parquet(cleaned_file, filters=[('source_file', 'in', sorted(file_links))])
+
+# Newly cleaned rows plus the rows kept from an earlier output, in the order of
+# monthly_files, keeping the first row of every business key as a full clean would
+def merge_cleaned_rows(kept, cleaned, monthly_files):
+    frames = [frame for frame in (kept, cleaned) if len(frame)] or [kept]
+    combined = concat_fuelcheck_frames(frames)
+    file_order = {file_link: i for i, (file_link, _) in enumerate(monthly_files)}
+    rank = combined['source_file'].astype(object).map(file_order).to_numpy()
+    combined = combined.iloc[np.argsort(rank, kind='stable')]
+    print("Rows before dropping duplicates with the kept rows:", len(combined))
+    combined = drop_duplicate_keys(combined).reset_index(drop=True)
+    print("Rows after dropping duplicates with the kept rows:", len(combined))
+    return combined
@@ -0,0 +1,141 @@
+import glob
+import os
+import shutil
+import duckdb
+from data_integration import DEDUP_KEY
+
+# Cleaned price rows as a Hive-partitioned Parquet dataset:
+# lake/fuel_prices/year=2024/month=3/FuelCode=E10/data_0.parquet. Readers scan
+# it with read_parquet (no lock on the DuckDB file) and filters on year, month
+# and FuelCode skip whole directories.
+PRICE_LAKE_DIR = 'lake/fuel_prices'
+LAKE_PARTITIONS = ['year', 'month', 'FuelCode']
+# Rows are sorted by time within a partition, so the min/max statistics of each
+# row group let readers skip groups outside a time range
+LAKE_ROW_GROUP_SIZE = 122880
+# Column types in the lake files whatever the cleaned input was (Parquet or CSV);
+# other columns are stored as VARCHAR
+LAKE_COLUMN_TYPES = {
+    'Postcode': 'USMALLINT',
+    'PriceUpdatedDate': 'TIMESTAMP',
+    'Price': 'FLOAT',
+    'AddressKey': 'BIGINT',
+}
+
+def lake_glob(lake_dir=PRICE_LAKE_DIR):
+    return os.path.join(lake_dir, 'year=*', 'month=*', 'FuelCode=*', '*.parquet')
+
+def lake_exists(lake_dir=PRICE_LAKE_DIR):
+    return bool(glob.glob(lake_glob(lake_dir)))
+
+def _lake_scan(paths):
+    return f"read_parquet({paths!r}, hive_partitioning = true, union_by_name = true)"
+
+# Write the cleaned price rows (the cleaned Parquet or CSV) to the lake. DuckDB
+# partitions the rows into a staging directory in one pass; each month is then
+# replaced with two renames (old directory out, new one in), so a reader never
+# sees a mix of old and new files for a month, but one listing the lake between
+# the renames finds that month missing. The swap is not atomic: a crash between
+# them leaves the month out of the lake until it is written again (the old
+# files stay under the hidden staging directory). Months not in the input are
+# left alone. With merge the rows already in the lake for those months are kept
+# and the input only adds rows with new business keys (for cleaned output that
+# only holds new rows, see main.SKIP_LOADED_ROWS). Returns the (year, month)
+# pairs written.
+def write_price_lake(cleaned_file, lake_dir=PRICE_LAKE_DIR, merge=False):
+    con = duckdb.connect()
+    if cleaned_file.endswith('.csv'):
+        source = f"read_csv({cleaned_file!r})"
+    else:
+        source = f"read_parquet({cleaned_file!r})"
+    columns = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+    select = ", ".join(
+        f'TRY_CAST("{col}" AS {LAKE_COLUMN_TYPES.get(col, "VARCHAR")}) AS "{col}"' for col in columns
+    )
+    con.execute(f"""
+        CREATE TEMP VIEW lake_input AS
+        SELECT {select} FROM {source}
+        WHERE TRY_CAST(PriceUpdatedDate AS TIMESTAMP) IS NOT NULL
+    """)
+    months = con.execute("""
+        SELECT DISTINCT year(PriceUpdatedDate), month(PriceUpdatedDate)
+        FROM lake_input ORDER BY ALL
+    """).fetchall()
+    if not months:
+        con.close()
+        print(f"No price rows to write to {lake_dir}")
+        return []
+
+    lake_rows = "SELECT * FROM lake_input"
+    existing_files = [path for year, month in months for path in glob.glob(
+        os.path.join(lake_dir, f'year={year}', f'month={month}', 'FuelCode=*', '*.parquet'))]
+    if merge and existing_files:
+        # Rows already in the lake win over input rows with the same key
+        key_columns = ", ".join(f'"{col}"' for col in DEDUP_KEY)
+        lake_rows = f"""
+            SELECT * EXCLUDE (lake_order) FROM (
+                SELECT *, 0 AS lake_order FROM {_lake_scan(existing_files)}
+                UNION ALL BY NAME
+                SELECT *, 1 AS lake_order FROM lake_input
+            )
+            QUALIFY row_number() OVER (PARTITION BY {key_columns} ORDER BY lake_order) = 1
+        """
+        lake_rows = f"SELECT * EXCLUDE (year, month) FROM ({lake_rows})"
+
+    staging_dir = os.path.join(lake_dir, f'.staging-{os.getpid()}')
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(lake_dir, exist_ok=True)
+    partitions = ", ".join(LAKE_PARTITIONS)
+    con.execute(f"""
+        COPY (
+            SELECT *, year(PriceUpdatedDate) AS year, month(PriceUpdatedDate) AS month
+            FROM ({lake_rows})
+            ORDER BY PriceUpdatedDate
+        ) TO {staging_dir!r} (FORMAT PARQUET, PARTITION_BY ({partitions}), ROW_GROUP_SIZE {LAKE_ROW_GROUP_SIZE})
+    """)
+    con.close()
+
+    replaced_dir = os.path.join(staging_dir, 'replaced')
+    for year, month in months:
+        month_path = os.path.join(f'year={year}', f'month={month}')
+        target = os.path.join(lake_dir, month_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.makedirs(os.path.join(replaced_dir, f'year={year}'), exist_ok=True)
+            os.rename(target, os.path.join(replaced_dir, month_path))
+        os.rename(os.path.join(staging_dir, month_path), target)
+    shutil.rmtree(staging_dir)
+    print(f"Wrote {len(months)} months to {lake_dir}")
+    return months
+
+# fuel_lake view over the lake in a DuckDB database, for queries that join it
+# to the star schema. The view reads the files at query time.
+def create_lake_view(con, lake_dir=PRICE_LAKE_DIR):
+    if not lake_exists(lake_dir):
+        return False
+    con.execute(f"CREATE OR REPLACE VIEW fuel_lake AS SELECT * FROM {_lake_scan(lake_glob(lake_dir))}")
+    return True
+
+# Price rows from the lake for one fuel code and/or a range of months
+# (inclusive (year, month) pairs). Runs on an in-memory connection, so it
+# never waits on the DuckDB file; only matching partitions are read.
+def lake_prices(fuelcode=None, start=None, end=None, columns='*', lake_dir=PRICE_LAKE_DIR):
+    filters, params = [], []
+    if fuelcode is not None:
+        filters.append("FuelCode = ?")
+        params.append(fuelcode)
+    if start is not None:
+        filters.append("year * 12 + month >= ?")
+        params.append(start[0] * 12 + start[1])
+    if end is not None:
+        filters.append("year * 12 + month <= ?")
+        params.append(end[0] * 12 + end[1])
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    con = duckdb.connect()
+    try:
+        return con.execute(
+            f"SELECT {columns} FROM {_lake_scan(lake_glob(lake_dir))} {where} ORDER BY PriceUpdatedDate", params
+        ).fetchdf()
+    finally:
+        con.close()
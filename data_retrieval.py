@@ -1,81 +1,390 @@
 #Retrieve Data
 #Import neceassary libraries 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 import pandas as pd
-from io import BytesIO
-from datetime import datetime
+import numpy as np
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
+import time
+from data_catalog import (discover_monthly_resources, load_catalog_manifest, save_catalog_manifest,
+                          diff_catalog_manifests, CATALOG_FIXTURE)
+from data_validation import MISSING_MARKERS, UNPARSEABLE_DATE
 DOWNLOAD_DIR = 'fuelcheck_monthly_files'
+# Catalog entries of the files on disk after the last retrieval, diffed
+# against the catalog on the next run
+CATALOG_MANIFEST_PATH = os.path.join(DOWNLOAD_DIR, 'catalog_manifest.json')
+# The last retrieval for cleaning: (link, local path) of every monthly file
+# ('files') and of those new or changed in it ('changed')
+MONTHLY_FILES_MANIFEST = os.path.join(DOWNLOAD_DIR, 'monthly_files.json')
+# Months to retrieve ('YYYY-MM', inclusive); no end means up to the latest published
+FUELCHECK_START = os.environ.get('FUELCHECK_START', '2024-01')
+FUELCHECK_END = os.environ.get('FUELCHECK_END') or None
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PARSED_CACHE_DIR = 'fuelcheck_parsed_cache'
+# Limits applied to the parsed cache after each retrieval (see prune_parsed_cache);
+# entries are touched when used, so the age is the time since last use
+PARSED_CACHE_MAX_AGE_DAYS = float(os.environ.get('PARSED_CACHE_MAX_AGE_DAYS', '90'))
+PARSED_CACHE_MAX_BYTES = int(os.environ['PARSED_CACHE_MAX_BYTES']) if os.environ.get('PARSED_CACHE_MAX_BYTES') else None
+STREAM_CHUNK_SIZE = 200_000
+# Bump when the parsing below changes so old cache entries are ignored
+PARSER_VERSION = 2
+# In-memory schema of the monthly data: the repetitive text columns (and the
+# source_file link added to every row) are categoricals, Postcode a nullable
+# uint16, Price a float32 and PriceUpdatedDate a datetime64[s]
+CATEGORY_COLUMNS = ['ServiceStationName', 'Address', 'Suburb', 'Brand', 'FuelCode', 'source_file']
 
-def retrieve_fuelcheck_monthly_data():
+# Shared session with a connection pool sized for the download workers
+def create_http_session(pool_size=DOWNLOAD_WORKERS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Sidecar file holding the ETag/Last-Modified of a downloaded file
+def _read_download_metadata(local_path):
+    meta_path = local_path + '.meta.json'
+    if not os.path.exists(meta_path):
+        return {}
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
+
+# True when local_path holds a complete earlier download (its size matches
+# the recorded one)
+def _has_complete_copy(local_path, metadata=None):
+    if metadata is None:
+        metadata = _read_download_metadata(local_path)
+    return os.path.exists(local_path) and metadata.get('size') == os.path.getsize(local_path)
+
+def _write_download_metadata(local_path, metadata):
+    meta_path = local_path + '.meta.json'
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as meta_file:
+        json.dump(metadata, meta_file)
+    os.replace(tmp_path, meta_path)
+
+# Download one file: conditional GET for cached files, Range resume for partial ones,
+# streamed into a .part file that is only renamed into place once complete
+def download_monthly_file(session, file_link, local_path):
+    partial_path = local_path + '.part'
+    metadata = _read_download_metadata(local_path)
+    partial_meta = metadata.get('partial', {})
+
+    # Ask for the raw bytes so Content-Length matches what lands on disk
+    headers = {'Accept-Encoding': 'identity'}
+    resume_from = 0
+    partial_validator = partial_meta.get('etag') or partial_meta.get('last_modified')
+    if os.path.exists(partial_path) and partial_validator:
+        resume_from = os.path.getsize(partial_path)
+        headers['Range'] = f"bytes={resume_from}-"
+        headers['If-Range'] = partial_validator
+    elif _has_complete_copy(local_path, metadata):
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+
+    with session.get(file_link, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            print(f"Not modified, using cached file: {local_path}")
+            return local_path
+        if response.status_code == 416:
+            # The partial file is not a valid prefix any more, start over
+            os.remove(partial_path)
+            return download_monthly_file(session, file_link, local_path)
+        response.raise_for_status()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code == 206:
+            print(f"Resuming download at byte {resume_from}: {file_link}")
+            mode = 'ab'
+            expected_size = int(response.headers['Content-Range'].split('/')[-1])
+        else:
+            print(f"Downloading: {file_link}")
+            mode = 'wb'
+            resume_from = 0
+            content_length = response.headers.get('Content-Length')
+            expected_size = int(content_length) if content_length else None
+
+        # Remember the validator of the partial file so an interrupted run can resume it
+        metadata['partial'] = {'etag': etag, 'last_modified': last_modified}
+        _write_download_metadata(local_path, metadata)
+
+        with open(partial_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    size = os.path.getsize(partial_path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(f"Incomplete download of {file_link}: {size} of {expected_size} bytes")
+
+    os.replace(partial_path, local_path)
+    _write_download_metadata(local_path, {
+        'url': file_link,
+        'etag': etag,
+        'last_modified': last_modified,
+        'size': size,
+    })
+    return local_path
+
+# Where a monthly file is kept: file:// links (offline catalog fixtures) are
+# used in place, everything else goes to DOWNLOAD_DIR
+def local_path_for(file_link):
+    if file_link.startswith('file://'):
+        return file_link[len('file://'):]
+    return os.path.join(DOWNLOAD_DIR, file_link.split('/')[-1])
+
+# Download all monthly files with a bounded worker pool sharing one session
+def download_monthly_files(download_links, max_workers=DOWNLOAD_WORKERS, session=None):
+    if session is None:
+        session = create_http_session(max_workers)
+
+    def fetch(file_link):
+        local_path = local_path_for(file_link)
+        if file_link.startswith('file://'):
+            return file_link, local_path if os.path.exists(local_path) else None
+        try:
+            return file_link, download_monthly_file(session, file_link, local_path)
+        except Exception as e:
+            # A failed refresh keeps the month in the run when the last
+            # complete download is still on disk
+            if _has_complete_copy(local_path):
+                print(f"Failed to refresh {file_link}, using the cached file {local_path}: {e}")
+                return file_link, local_path
+            print(f"Failed to download {file_link}: {e}")
+            return file_link, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch, download_links))
+
+    # Keep the page order of the links so the combined dataset is stable
+    return [(file_link, local_path) for file_link, local_path in results if local_path]
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Parquet needs one type per column, so mixed object columns (e.g. dates typed as
+# text in some rows) are stored as strings while nulls are kept as nulls
+def make_arrow_safe(df):
+    for col in df.select_dtypes(include='object').columns:
+        values = df[col].dropna()
+        if not values.map(type).eq(str).all():
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+# Cast a monthly frame to the compact schema (columns that are missing are skipped)
+def apply_fuelcheck_schema(df):
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    if 'Postcode' in df.columns:
+        postcodes = pd.to_numeric(df['Postcode'], errors='coerce').round()
+        df['Postcode'] = postcodes.where(postcodes.between(0, 65535)).astype('UInt16')
+    if 'Price' in df.columns:
+        df['Price'] = pd.to_numeric(df['Price'], errors='coerce').astype('float32')
+    if 'PriceUpdatedDate' in df.columns:
+        df['PriceUpdatedDate'] = parse_price_dates(df['PriceUpdatedDate'])
+    return df
+
+# PriceUpdatedDate as datetime64[s]: missing values (nulls and MISSING_MARKERS)
+# become NaT, for the date fill, and values that are not dates UNPARSEABLE_DATE,
+# for validation to reject
+def parse_price_dates(values):
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values.astype('datetime64[s]')
+    text = values.astype('string').str.strip()
+    missing = text.isna() | text.str.lower().isin(MISSING_MARKERS)
+    dates = pd.to_datetime(text.mask(missing), errors='coerce')
+    return dates.mask(dates.isna() & ~missing, UNPARSEABLE_DATE).astype('datetime64[s]')
+
+# The link of a monthly file as a column for its rows: one category, so the
+# link is stored once rather than once per row
+def source_file_column(file_link, rows):
+    return pd.Categorical.from_codes(np.zeros(rows, dtype=np.int8), categories=[file_link])
+
+# Concatenate monthly frames without losing the categoricals: pd.concat falls
+# back to object columns when the categories differ, so every frame gets the
+# union of the categories first (this only remaps the integer codes)
+def concat_fuelcheck_frames(frames):
+    for col in CATEGORY_COLUMNS:
+        columns = [frame[col] for frame in frames if col in frame.columns]
+        if not columns or not all(isinstance(column.dtype, pd.CategoricalDtype) for column in columns):
+            continue
+        categories = pd.Index(pd.concat([pd.Series(column.cat.categories) for column in columns]).unique())
+        for frame in frames:
+            if col in frame.columns:
+                frame[col] = frame[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+def _parse_monthly_file(local_path):
+    if local_path.endswith(('.xls', '.xlsx')):
+        return pd.read_excel(local_path)
+    elif local_path.endswith('.csv'):
+        return pd.read_csv(local_path)
+    return None
+
+# Return the Parquet copy of a parsed monthly file, parsing it first unless this
+# exact file content was already parsed by the current parser version. The
+# dates are stored parsed, so reading the copy builds no per-row strings.
+def parsed_cache_path(local_path):
+    os.makedirs(PARSED_CACHE_DIR, exist_ok=True)
+    filename = os.path.basename(local_path)
+    content_hash = _file_sha256(local_path)
+    cache_path = os.path.join(PARSED_CACHE_DIR, f"{filename}.{content_hash[:16]}.v{PARSER_VERSION}.parquet")
+
+    if os.path.exists(cache_path):
+        print(f"Using parsed cache: {cache_path}")
+        os.utime(cache_path)  # Keep recently used entries from being pruned by age
+        return cache_path
+
+    df_month = _parse_monthly_file(local_path)
+    if df_month is None:
+        return None
+    if 'PriceUpdatedDate' in df_month.columns:
+        df_month['PriceUpdatedDate'] = parse_price_dates(df_month['PriceUpdatedDate'])
+    df_month = make_arrow_safe(df_month)
+
+    tmp_path = cache_path + '.tmp'
+    df_month.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+
+    # Entries for older content or parser versions of the same file are stale
+    for entry in os.listdir(PARSED_CACHE_DIR):
+        entry_path = os.path.join(PARSED_CACHE_DIR, entry)
+        if entry.startswith(filename + '.') and entry_path != cache_path:
+            os.remove(entry_path)
+            print(f"Removed stale parsed cache: {entry_path}")
+
+    return cache_path
+
+# Load a monthly file through the parsed cache (memory-mapped Parquet). The
+# text columns are read as dictionaries, so they arrive as categoricals without
+# building a Python string per row.
+def load_monthly_file(local_path):
+    cache_path = parsed_cache_path(local_path)
+    if cache_path is None:
+        return None
+    parquet_file = pq.ParquetFile(cache_path, memory_map=True)
+    dictionary_columns = [col for col in CATEGORY_COLUMNS if col in parquet_file.schema_arrow.names]
+    table = pq.read_table(cache_path, memory_map=True, read_dictionary=dictionary_columns)
+    # Hand the Arrow buffers over column by column instead of holding both copies
+    return apply_fuelcheck_schema(table.to_pandas(self_destruct=True, split_blocks=True))
+
+# Yield a monthly file in chunks of at most chunksize rows. CSVs are read
+# incrementally; spreadsheets can only be parsed whole, so they are parsed once
+# into the cache and read back one row batch at a time
+def iter_monthly_file_chunks(local_path, chunksize=STREAM_CHUNK_SIZE):
+    if local_path.endswith('.csv'):
+        header = pd.read_csv(local_path, nrows=0).columns
+        dtypes = {col: 'category' for col in CATEGORY_COLUMNS if col in header}
+        for chunk in pd.read_csv(local_path, chunksize=chunksize, dtype=dtypes):
+            yield apply_fuelcheck_schema(chunk)
+        return
+
+    cache_path = parsed_cache_path(local_path)
+    if cache_path is None:
+        return
+    probe = pq.ParquetFile(cache_path, memory_map=True)
+    dictionary_columns = [col for col in CATEGORY_COLUMNS if col in probe.schema_arrow.names]
+    parquet_file = pq.ParquetFile(cache_path, memory_map=True, read_dictionary=dictionary_columns)
+    for batch in parquet_file.iter_batches(batch_size=chunksize):
+        yield apply_fuelcheck_schema(batch.to_pandas())
+
+# Drop parsed cache entries older than max_age_days, then the least recently
+# used ones until the cache fits in max_bytes
+def prune_parsed_cache(max_bytes=PARSED_CACHE_MAX_BYTES, max_age_days=PARSED_CACHE_MAX_AGE_DAYS):
+    if not os.path.exists(PARSED_CACHE_DIR):
+        return
+
+    entries = []
+    for entry in os.listdir(PARSED_CACHE_DIR):
+        entry_path = os.path.join(PARSED_CACHE_DIR, entry)
+        stat = os.stat(entry_path)
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+    entries.sort()
+
+    if max_age_days is not None:
+        cutoff = time.time() - max_age_days * 86400
+        for entry in [e for e in entries if e[0] < cutoff]:
+            os.remove(entry[2])
+            entries.remove(entry)
+            print(f"Pruned parsed cache entry: {entry[2]}")
+
+    if max_bytes is not None:
+        total = sum(size for _, size, _ in entries)
+        while entries and total > max_bytes:
+            _, size, entry_path = entries.pop(0)
+            os.remove(entry_path)
+            total -= size
+            print(f"Pruned parsed cache entry: {entry_path}")
+
+# Make sure every monthly file between start and end is on disk and return
+# (file_link, local_path) pairs, oldest month first. The files are found in the
+# CKAN catalog; only resources that are new or changed since the last run (or
+# missing locally) are requested, so a run with nothing new published costs a
+# single metadata request. changes, when given (a list), gets the pairs of the
+# files requested in this run, so later stages can work on just those months.
+def fetch_monthly_files(start=FUELCHECK_START, end=FUELCHECK_END, fixture=CATALOG_FIXTURE, changes=None):
     # Create directory if it doesn't exist
     if not os.path.exists(DOWNLOAD_DIR):
         os.makedirs(DOWNLOAD_DIR)
         print(f"Created directory: {DOWNLOAD_DIR}")
     else:
         print(f"Directory already exists: {DOWNLOAD_DIR}")
-        # return
-
-    print("Retrieving NSW FuelCheck monthly data from Jan 2024 – Mar 2025...")
 
-    base_url = "https://data.nsw.gov.au/data/dataset/fuel-check"
-    html_response = requests.get(base_url)
-    soup = BeautifulSoup(html_response.text, "html.parser")
+    print(f"Retrieving NSW FuelCheck monthly data from {start} to {end or 'the latest month'}...")
 
-    allowed_extensions = ['.xlsx', '.xls', '.csv']
-    long_months = ['january', 'february', 'march', 'april', 'may', 'june',
-                   'july', 'august', 'september', 'october', 'november', 'december']
-    short_months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
-                    'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    session = create_http_session()
+    resources = discover_monthly_resources(start, end, session=session, fixture=fixture)
+    diff = diff_catalog_manifests(load_catalog_manifest(CATALOG_MANIFEST_PATH), resources)
+    print(f"Found {len(resources)} monthly files: {len(diff['new'])} new, {len(diff['changed'])} changed, "
+          f"{len(diff['unchanged'])} unchanged, {len(diff['removed'])} no longer listed")
 
-    target_patterns = [m + "2024" for m in long_months] + [m + "2024" for m in short_months]
-    target_patterns += [m + "2025" for m in long_months[:3]] + [m + "2025" for m in short_months[:3]]
-    target_patterns += [m + "25" for m in long_months[:3]] + [m + "25" for m in short_months[:3]]
+    on_disk = {entry['url']: local_path_for(entry['url']) for entry in diff['unchanged']
+               if os.path.exists(local_path_for(entry['url']))}
+    download_links = [entry['url'] for entry in resources if entry['url'] not in on_disk]
+    downloaded = download_monthly_files(download_links, session=session)
+    on_disk.update(downloaded)
+    if changes is not None:
+        changes.extend(downloaded)
 
-    download_links = []
-    for tag in soup.find_all("a", href=True):
-        href = tag['href'].lower()
-        if any(href.endswith(ext) for ext in allowed_extensions):
-            clean_href = href.replace('-', '').replace('_', '')
-            if any(pattern in clean_href for pattern in target_patterns):
-                download_links.append(tag['href'])
-
-    print(f"Found {len(download_links)} monthly files.")
+    # Files that failed to download stay out of the manifest, so the next run retries them
+    save_catalog_manifest(CATALOG_MANIFEST_PATH, [entry for entry in resources if entry['url'] in on_disk])
+    return [(entry['url'], on_disk[entry['url']]) for entry in resources if entry['url'] in on_disk]
 
+# monthly_files is the [(link, path)] list from fetch_monthly_files(); when it
+# is not given the files are fetched first
+def retrieve_fuelcheck_monthly_data(monthly_files=None):
+    if monthly_files is None:
+        monthly_files = fetch_monthly_files()
     monthly_dataframes = []
-    for file_link in download_links:
-        filename = file_link.split('/')[-1]  # Extract file name from URL
-        local_path = os.path.join(DOWNLOAD_DIR, filename)
-
-        if os.path.exists(local_path):
-            print(f"Using cached file: {local_path}")
-            if filename.endswith(('.xls', '.xlsx')):
-                df_month = pd.read_excel(local_path)
-            elif filename.endswith('.csv'):
-                df_month = pd.read_csv(local_path)
-        else:
-            try:
-                print(f"Downloading: {file_link}")
-                response = requests.get(file_link)
-                with open(local_path, 'wb') as f:
-                    f.write(response.content)
-
-                if filename.endswith(('.xls', '.xlsx')):
-                    df_month = pd.read_excel(local_path)
-                elif filename.endswith('.csv'):
-                    df_month = pd.read_csv(local_path)
-                else:
-                    continue
-            except Exception as e:
-                print(f"Failed to load {file_link}: {e}")
+    for file_link, local_path in monthly_files:
+        try:
+            df_month = load_monthly_file(local_path)
+            if df_month is None:
                 continue
+        except Exception as e:
+            print(f"Failed to load {file_link}: {e}")
+            continue
 
-        df_month['source_file'] = file_link
+        df_month['source_file'] = source_file_column(file_link, len(df_month))
         monthly_dataframes.append(df_month)
 
     if monthly_dataframes:
-        combined_df = pd.concat(monthly_dataframes, ignore_index=True)
+        combined_df = concat_fuelcheck_frames(monthly_dataframes)
         print(f"Combined dataset shape: {combined_df.shape}")
         return combined_df
     else:
@@ -0,0 +1,198 @@
+import math
+import os
+import duckdb
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+from data_analytics import DB_PATH
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+# Side of a grid cell in the station index
+GRID_CELL_KM = 5.0
+
+# Latest price of every fuel at every geocoded station, rebuilt after each load
+# from current_prices (see data_history) so spatial lookups never scan the
+# fact table
+def refresh_station_latest_prices(con):
+    con.execute("""
+        CREATE OR REPLACE TABLE station_latest_prices AS
+        SELECT s.station_id, s.servicestationname, s.address, s.suburb, s.postcode,
+               b.brand, f.fuelcode, p.price, p.priceupdateddate,
+               CAST(g.Latitude AS DOUBLE) AS latitude,
+               CAST(g.Longitude AS DOUBLE) AS longitude
+        FROM current_prices p
+        JOIN stations s ON s.station_id = p.station_id
+        JOIN GEO_MAPPING g ON g.AddressKey = s.address_key
+        LEFT JOIN brands b ON b.brand_id = s.brand_id
+        LEFT JOIN fuel_codes f ON f.fuel_id = p.fuel_id
+        WHERE g.Latitude IS NOT NULL AND g.Longitude IS NOT NULL
+        ORDER BY f.fuelcode, s.station_id
+    """)
+
+# Great-circle distance in km; arguments broadcast like NumPy arrays
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+# In-memory grid index over station coordinates for one fuel code. Stations are
+# bucketed into cells at least cell_km wide and sorted by cell, so the cells of
+# one grid column form a single slice found with searchsorted. A query only
+# measures distances to stations in the cells around the point.
+class StationPriceIndex:
+    def __init__(self, stations: pd.DataFrame, cell_km: float = GRID_CELL_KM):
+        stations = stations.dropna(subset=['latitude', 'longitude', 'price'])
+        self.cell_km = cell_km
+        self.dlat = cell_km / KM_PER_DEGREE
+        max_abs_lat = float(np.abs(stations['latitude']).max()) if len(stations) else 0.0
+        self.dlon = cell_km / (KM_PER_DEGREE * math.cos(math.radians(min(max_abs_lat + self.dlat, 89.0))))
+
+        ix = np.floor(stations['longitude'].to_numpy(float) / self.dlon).astype(np.int64)
+        iy = np.floor(stations['latitude'].to_numpy(float) / self.dlat).astype(np.int64)
+        self.ix_min, self.iy_min = (int(ix.min()), int(iy.min())) if len(stations) else (0, 0)
+        self.nx = int(ix.max()) - self.ix_min + 1 if len(stations) else 0
+        self.ny = int(iy.max()) - self.iy_min + 1 if len(stations) else 0
+
+        cell_keys = (ix - self.ix_min) * self.ny + (iy - self.iy_min)
+        order = np.argsort(cell_keys, kind='stable')
+        self.cell_keys = cell_keys[order]
+        self.stations = stations.iloc[order].reset_index(drop=True)
+        self.latitude = self.stations['latitude'].to_numpy(float)
+        self.longitude = self.stations['longitude'].to_numpy(float)
+        self.price = self.stations['price'].to_numpy(float)
+
+    @classmethod
+    def from_duckdb(cls, fuelcode: str, db_path: str = DB_PATH, cell_km: float = GRID_CELL_KM):
+        con = duckdb.connect(db_path, read_only=True)
+        try:
+            stations = con.execute(
+                "SELECT * FROM station_latest_prices WHERE fuelcode = ?", [fuelcode]
+            ).fetchdf()
+        finally:
+            con.close()
+        return cls(stations, cell_km)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(longitude / self.dlon) - self.ix_min,
+                math.floor(latitude / self.dlat) - self.iy_min)
+
+    # Station positions in the (2 * ring + 1)^2 cells centred on (cx, cy)
+    def _candidates(self, cx, cy, ring):
+        columns = np.arange(max(cx - ring, 0), min(cx + ring, self.nx - 1) + 1)
+        y_low, y_high = max(cy - ring, 0), min(cy + ring, self.ny - 1)
+        if not len(columns) or y_low > y_high:
+            return np.empty(0, dtype=np.int64)
+        starts = np.searchsorted(self.cell_keys, columns * self.ny + y_low, side='left')
+        ends = np.searchsorted(self.cell_keys, columns * self.ny + y_high, side='right')
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    # Smallest ring around (cx, cy) that covers every cell of the grid
+    def _max_ring(self, cx, cy):
+        return max(cx, self.nx - 1 - cx, cy, self.ny - 1 - cy, 0)
+
+    # (positions, distances) of the stations within radius_km, cheapest first
+    def _within(self, latitude, longitude, radius_km):
+        cx, cy = self._cell(latitude, longitude)
+        ring = min(math.ceil(radius_km / self.cell_km), self._max_ring(cx, cy))
+        candidates = self._candidates(cx, cy, ring)
+        distances = haversine_km(latitude, longitude, self.latitude[candidates], self.longitude[candidates])
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.lexsort((distances, self.price[candidates]))
+        return candidates[order], distances[order]
+
+    # (positions, distances) of the k nearest stations, nearest first. The search
+    # grows one ring of cells at a time until the k-th distance is inside the
+    # searched square, since nothing outside it can be closer.
+    def _nearest(self, latitude, longitude, k):
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        cx, cy = self._cell(latitude, longitude)
+        max_ring = self._max_ring(cx, cy)
+        # Points outside the grid start at the first ring that reaches it
+        ring = max(0, -cx, cx - (self.nx - 1), -cy, cy - (self.ny - 1))
+        while True:
+            candidates = self._candidates(cx, cy, ring)
+            if len(candidates) >= k or ring >= max_ring:
+                distances = haversine_km(latitude, longitude, self.latitude[candidates], self.longitude[candidates])
+                order = np.argsort(distances, kind='stable')[:k]
+                if ring >= max_ring or distances[order[-1]] <= ring * self.cell_km:
+                    return candidates[order], distances[order]
+            ring += 1
+
+    def _rows(self, positions, distances):
+        rows = self.stations.iloc[positions].reset_index(drop=True)
+        rows['distance_km'] = distances
+        return rows
+
+    # Stations selling this fuel within radius_km of the point, cheapest first
+    def within(self, latitude: float, longitude: float, radius_km: float, limit: Optional[int] = None) -> pd.DataFrame:
+        positions, distances = self._within(latitude, longitude, radius_km)
+        return self._rows(positions[:limit], distances[:limit])
+
+    # The k stations nearest to the point, nearest first
+    def nearest(self, latitude: float, longitude: float, k: int = 5) -> pd.DataFrame:
+        positions, distances = self._nearest(latitude, longitude, k)
+        return self._rows(positions, distances)
+
+    # Cheapest station within radius_km of each (latitude, longitude) row of
+    # points. Returns positions into self.stations (-1 where nothing is in range),
+    # prices and distances (NaN where nothing is in range).
+    def cheapest_within_batch(self, points: np.ndarray, radius_km: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        positions = np.full(len(points), -1, dtype=np.int64)
+        distances = np.full(len(points), np.nan)
+        for i, (latitude, longitude) in enumerate(points):
+            found, found_distances = self._within(latitude, longitude, radius_km)
+            if len(found):
+                positions[i], distances[i] = found[0], found_distances[0]
+        prices = np.where(positions >= 0, self.price[positions], np.nan) if len(self) else np.full(len(points), np.nan)
+        return positions, prices, distances
+
+    # k nearest stations to each (latitude, longitude) row of points, as (n, k)
+    # arrays of positions into self.stations (-1 padded) and distances (inf padded)
+    def nearest_batch(self, points: np.ndarray, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        positions = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+        for i, (latitude, longitude) in enumerate(points):
+            found, found_distances = self._nearest(latitude, longitude, k)
+            positions[i, :len(found)] = found
+            distances[i, :len(found)] = found_distances
+        return positions, distances
+
+# Indexes by (db_path, fuelcode), rebuilt when the database file changes
+_indexes = {}
+
+def station_price_index(fuelcode: str, db_path: str = DB_PATH) -> StationPriceIndex:
+    modified = os.path.getmtime(db_path)
+    cached = _indexes.get((db_path, fuelcode))
+    if cached is None or cached[0] != modified:
+        cached = (modified, StationPriceIndex.from_duckdb(fuelcode, db_path))
+        _indexes[(db_path, fuelcode)] = cached
+    return cached[1]
+
+# Cheapest stations selling fuelcode within radius_km of a point
+def cheapest_within(
+    fuelcode: str,
+    latitude: float,
+    longitude: float,
+    radius_km: float = 5.0,
+    limit: int = 10,
+    db_path: str = DB_PATH,
+) -> pd.DataFrame:
+    return station_price_index(fuelcode, db_path).within(latitude, longitude, radius_km, limit)
+
+# The k stations selling fuelcode nearest to a point, with their latest price
+def nearest_stations(
+    fuelcode: str,
+    latitude: float,
+    longitude: float,
+    k: int = 5,
+    db_path: str = DB_PATH,
+) -> pd.DataFrame:
+    return station_price_index(fuelcode, db_path).nearest(latitude, longitude, k)
@@ -1,26 +1,36 @@
 import duckdb
 import pandas as pd
 import os
+from datetime import datetime
+from data_integration import cleaned_frame_to_arrow, row_key_hashes, SeenKeys, DEDUP_KEY
+from data_analytics import refresh_price_rollups, average_price_by_fuelcode
+from data_addresses import address_keys
+from data_spatial import refresh_station_latest_prices
+from data_history import refresh_price_history
+from data_lake import create_lake_view, lake_exists, lake_glob, lake_prices, PRICE_LAKE_DIR
+from data_validation import load_quarantine, flag_foreign_keys
+from metrics import verbose
 
-def store_to_duckdb(fuel_df, fuel_details_df, geo_mapping_df):
-    print(fuel_df.shape, fuel_details_df.shape, geo_mapping_df.shape)
-    
-    # make directory
-    os.makedirs("db", exist_ok=True)
-    con = duckdb.connect("db/fuelcheck.duckdb")
-
-    # Drop existing tables and sequence
-    con.execute("DROP TABLE IF EXISTS fuel_data")
-    con.execute("DROP TABLE IF EXISTS FUEL_DETAILS")
-    con.execute("DROP TABLE IF EXISTS GEO_MAPPING")
-    con.execute("DROP SEQUENCE IF EXISTS station_id_seq")
+# Columns that identify a price row, used to fingerprint the rows of a month
+FUEL_DATA_KEY = ['servicestationname', 'address', 'suburb', 'postcode', 'brand',
+                 'fuelcode', 'priceupdateddate', 'price']
+# Natural key of a station, and of a row in the fuel_prices fact table
+STATION_KEY = ['servicestationname', 'address', 'suburb', 'postcode', 'brand_id']
+FACT_KEY = ['station_id', 'fuel_id', 'priceupdateddate', 'price']
+# Text columns of the cleaned CSV
+TEXT_COLUMNS = ['ServiceStationName', 'Address', 'Suburb', 'Brand', 'FuelCode', 'PriceUpdatedDate', 'source_file']
 
-    # Create sequence
-    con.execute("CREATE SEQUENCE station_id_seq START 1")
+def create_fuel_tables(con):
+    # Create sequences: station_id_seq keeps numbering fuel_prices rows as
+    # station_tracking_id, the others hand out dimension keys
+    con.execute("CREATE SEQUENCE IF NOT EXISTS station_id_seq START 1")
+    con.execute("CREATE SEQUENCE IF NOT EXISTS station_key_seq START 1")
+    con.execute("CREATE SEQUENCE IF NOT EXISTS brand_id_seq START 1")
+    con.execute("CREATE SEQUENCE IF NOT EXISTS fuel_id_seq START 1")
 
     # Create FUEL_DETAILS table
     con.execute("""
-        CREATE TABLE FUEL_DETAILS (
+        CREATE TABLE IF NOT EXISTS FUEL_DETAILS (
             FuelCode VARCHAR(3),
             FuelType VARCHAR(20) NOT NULL,
             Sales DECIMAL(10, 2),
@@ -29,123 +39,440 @@ def store_to_duckdb(fuel_df, fuel_details_df, geo_mapping_df):
         );
     """)
 
-    # Create GEO_MAPPING table
+    # Create GEO_MAPPING table, one row per canonical address (see data_addresses)
     con.execute("""
-        CREATE TABLE GEO_MAPPING (
-            Address VARCHAR(100) PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS GEO_MAPPING (
+            AddressKey BIGINT PRIMARY KEY,
+            Address VARCHAR(100),
             Latitude DECIMAL(9,6),
-            Longitude DECIMAL(9,6)
+            Longitude DECIMAL(9,6),
+            MatchConfidence DECIMAL(4,3)
         );
     """)
 
-    # Create fuel_data table with foreign keys
+    # Dimension tables. Fuel codes are a lookup table rather than a DuckDB ENUM
+    # because an ENUM cannot be extended when a new code shows up in a later month.
     con.execute("""
-        CREATE TABLE fuel_data (
-            station_tracking_id INTEGER DEFAULT nextval('station_id_seq') PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS brands (
+            brand_id INTEGER PRIMARY KEY,
+            brand TEXT NOT NULL UNIQUE
+        );
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS fuel_codes (
+            fuel_id SMALLINT PRIMARY KEY,
+            fuelcode VARCHAR(3) NOT NULL UNIQUE
+        );
+    """)
+    # address_key is not a foreign key: prices load before their address is
+    # geocoded (flagged as address_not_geocoded) and join GEO_MAPPING once it is
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS stations (
+            station_id INTEGER PRIMARY KEY,
             servicestationname TEXT,
             address VARCHAR(100),
+            address_key BIGINT,
             suburb TEXT,
             postcode INTEGER,
-            brand TEXT,
-            fuelcode VARCHAR(3),
-            fuel_date DATE,
-            priceupdateddate DATE,
+            brand_id INTEGER,
+            FOREIGN KEY (brand_id) REFERENCES brands(brand_id)
+        );
+    """)
+
+    # Narrow fact table with one row per price update
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS fuel_prices (
+            station_tracking_id INTEGER DEFAULT nextval('station_id_seq') PRIMARY KEY,
+            station_id INTEGER NOT NULL,
+            fuel_id SMALLINT,
+            priceupdateddate TIMESTAMP,
             price FLOAT,
-            FOREIGN KEY (fuelcode, fuel_date) REFERENCES FUEL_DETAILS(FuelCode, Date),
-            FOREIGN KEY (address) REFERENCES GEO_MAPPING(Address)
+            FOREIGN KEY (station_id) REFERENCES stations(station_id),
+            FOREIGN KEY (fuel_id) REFERENCES fuel_codes(fuel_id)
         );
     """)
 
-    # Convert 'PriceUpdatedDate' to datetime, set day=1, and format as 'YYYY-MM-DD'
-    fuel_df['fuel_date'] = pd.to_datetime(fuel_df['PriceUpdatedDate'], errors='coerce')
+    # fuel_data keeps the original wide column layout as a view over the fact table
+    con.execute("""
+        CREATE OR REPLACE VIEW fuel_data AS
+        SELECT p.station_tracking_id,
+               s.servicestationname,
+               s.address,
+               s.suburb,
+               s.postcode,
+               b.brand,
+               f.fuelcode,
+               CAST(date_trunc('month', p.priceupdateddate) AS DATE) AS fuel_date,
+               p.priceupdateddate,
+               p.price
+        FROM fuel_prices p
+        JOIN stations s ON s.station_id = p.station_id
+        LEFT JOIN brands b ON b.brand_id = s.brand_id
+        LEFT JOIN fuel_codes f ON f.fuel_id = p.fuel_id
+    """)
 
-    # Drop rows with invalid dates
-    fuel_df = fuel_df.dropna(subset=['fuel_date'])
+    # One row per loaded month with a fingerprint of its rows, so incremental
+    # loads can tell which months are new or changed
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS load_manifest (
+            month DATE PRIMARY KEY,
+            source_files TEXT,
+            row_count BIGINT,
+            fingerprint HUGEINT,
+            loaded_at TIMESTAMP
+        );
+    """)
 
-    # Force the day to be 1 and format as 'YYYY-MM-DD'
-    fuel_df['fuel_date'] = fuel_df['fuel_date'].apply(lambda x: x.replace(day=1)).dt.strftime('%Y-%m-%d')
+def drop_fuel_tables(con):
+    # fuel_data is a table in databases written before the star schema
+    fuel_data_type = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = 'fuel_data'"
+    ).fetchone()
+    if fuel_data_type and fuel_data_type[0] == 'VIEW':
+        con.execute("DROP VIEW fuel_data")
+    elif fuel_data_type:
+        con.execute("DROP TABLE fuel_data")
 
-    # Convert 'MM-YYYY' to 'YYYY-MM-DD'
-    fuel_details_df['Month'] = pd.to_datetime(fuel_details_df['Month'], format='%m-%Y').dt.strftime('%Y-%m-%d')
+    # Drop existing tables and sequences, children before parents
+    for table in ['fuel_prices', 'stations', 'brands', 'fuel_codes',
+                  'FUEL_DETAILS', 'GEO_MAPPING', 'load_manifest',
+                  'price_rollup_daily', 'price_rollup_monthly', 'station_latest_prices',
+                  'current_prices', 'price_history', 'quarantine']:
+        con.execute(f"DROP TABLE IF EXISTS {table}")
+    for sequence in ['station_id_seq', 'station_key_seq', 'brand_id_seq', 'fuel_id_seq']:
+        con.execute(f"DROP SEQUENCE IF EXISTS {sequence}")
 
-    fuel_details_df = fuel_details_df.rename(columns={
-        'Month': 'Date',
-        'Product': 'FuelType',
-        'SalesValue': 'Sales'
-    })
+# True for databases written before the star schema (fuel_data as a table),
+# before GEO_MAPPING was keyed by AddressKey, before prices kept their time of
+# day or while stations.address_key still had to be geocoded (a foreign key);
+# those need a full load
+def has_legacy_schema(con):
+    legacy_fuel_data = con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'fuel_data' AND table_type = 'BASE TABLE'"
+    ).fetchone()[0] > 0
+    geo_columns = [row[0].lower() for row in con.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = 'GEO_MAPPING'"
+    ).fetchall()]
+    date_only_prices = con.execute(
+        "SELECT COUNT(*) FROM information_schema.columns "
+        "WHERE table_name = 'fuel_prices' AND column_name = 'priceupdateddate' AND data_type = 'DATE'"
+    ).fetchone()[0] > 0
+    geocoded_stations_only = con.execute(
+        "SELECT COUNT(*) FROM duckdb_constraints() "
+        "WHERE table_name = 'stations' AND constraint_type = 'FOREIGN KEY' AND constraint_text ILIKE '%GEO_MAPPING%'"
+    ).fetchone()[0] > 0
+    return (legacy_fuel_data or (bool(geo_columns) and 'addresskey' not in geo_columns) or date_only_prices
+            or geocoded_stations_only)
 
-    print("FUEL DF", fuel_df.head())
-    print("FUEL DETAILS DF", fuel_details_df.head())
+# fuel_df is either the cleaned DataFrame or the path of the cleaned Parquet or
+# CSV output. All are read by DuckDB and the keys are prepared in SQL.
+# A full load rebuilds every table; an incremental load keeps what is already
+# loaded and only applies months whose rows changed. Either way everything runs
+# in one transaction, and the list of months that were (re)loaded is returned.
+# append is for input that only holds rows not loaded before (cleaned against
+# the seen keys): its rows are added to their months without the change
+# detection, which would otherwise delete every row missing from the input.
+# With seen_keys_path the business-key hashes of the loaded rows are written
+# there once the load has committed (replacing the file on a full load).
+# quarantine_file holds the rows rejected while cleaning (see data_validation);
+# they replace the rejected rows in the quarantine table, next to the rows
+# flagged for unknown fuel codes or addresses during this load.
+def store_to_duckdb(fuel_df, fuel_details_df, geo_mapping_df, incremental=False, append=False, seen_keys_path=None,
+                    quarantine_file=None):
+    from_file = isinstance(fuel_df, str)
+    print(fuel_df if from_file else fuel_df.shape, fuel_details_df.shape, geo_mapping_df.shape)
+    
+    # make directory
+    os.makedirs("db", exist_ok=True)
+    con = duckdb.connect("db/fuelcheck.duckdb")
+    con.execute("BEGIN TRANSACTION")
 
-    invalid_rows = fuel_df.merge(
-    fuel_details_df[['FuelCode', 'Date']],
-        left_on=['FuelCode', 'fuel_date'],
-        right_on=['FuelCode', 'Date'],
-        how='left',
-        indicator=True
-    ).query("_merge == 'left_only'")
+    if append and (not incremental or has_legacy_schema(con)):
+        con.execute("ROLLBACK")
+        con.close()
+        raise ValueError("Appending needs an incremental load into the current table layout; "
+                         "load the full cleaned data once first")
+    if incremental and has_legacy_schema(con):
+        print("Database uses an older table layout, doing a full load instead")
+        incremental = False
+    if not incremental:
+        drop_fuel_tables(con)
 
-    print("Invalid rows due to missing foreign keys:")
-    print(invalid_rows[['FuelCode', 'fuel_date']].drop_duplicates())
+    create_fuel_tables(con)
 
-    # Find missing combinations
-    missing_combinations = fuel_df.merge(
-        fuel_details_df[['FuelCode', 'Date']],
-        left_on=['FuelCode', 'fuel_date'],
-        right_on=['FuelCode', 'Date'],
-        how='left',
-        indicator=True
-    ).query("_merge == 'left_only'")[['FuelCode', 'fuel_date']].drop_duplicates()
+    # 'MM-YYYY' to a native month-start date
+    fuel_details_df['Month'] = pd.to_datetime(fuel_details_df['Month'], format='%m-%Y')
 
-    # Create placeholder rows
-    placeholder_fuel_details = missing_combinations.rename(columns={
-        'fuel_date': 'Date'
+    fuel_details_df = fuel_details_df.rename(columns={
+        'Month': 'Date',
+        'Product': 'FuelType',
+        'SalesValue': 'Sales'
     })
-    placeholder_fuel_details['FuelType'] = 'UNKNOWN'
-    placeholder_fuel_details['Sales'] = 0.0
 
-    # Append to original FUEL_DETAILS
-    fuel_details_df = pd.concat([fuel_details_df, placeholder_fuel_details], ignore_index=True)
-
-    
-    # Register DataFrames
-    con.register("fuel_df", fuel_df)
+    # Register the price rows and the lookup tables. Parquet files (or a directory
+    # of them) and CSVs are scanned by DuckDB directly; a DataFrame is handed over
+    # as an Arrow table so strings are not converted one Python object at a time.
+    if from_file and (fuel_df.endswith('.parquet') or os.path.isdir(fuel_df)):
+        if os.path.isdir(fuel_df) and lake_exists(fuel_df):
+            # The partitioned price lake (see data_lake); FuelCode comes from the paths
+            con.read_parquet(lake_glob(fuel_df), hive_partitioning=True).create_view("fuel_input")
+        else:
+            parquet_glob = os.path.join(fuel_df, '**', '*.parquet') if os.path.isdir(fuel_df) else fuel_df
+            con.read_parquet(parquet_glob).create_view("fuel_input")
+    elif from_file:
+        # Text columns are typed explicitly: a CSV with no rows (nothing new to
+        # append) would otherwise have them inferred as BOOLEAN
+        header = pd.read_csv(fuel_df, nrows=0).columns
+        text_types = {col: 'VARCHAR' for col in TEXT_COLUMNS if col in header}
+        con.read_csv(fuel_df, dtype=text_types).create_view("fuel_input")
+    else:
+        con.register("fuel_input", cleaned_frame_to_arrow(fuel_df))
     con.register("fuel_details_df", fuel_details_df)
+    # Key the geocoded addresses the same way as the price rows; spelling
+    # variants collapse onto the first one listed
+    geo_mapping_df = geo_mapping_df.assign(AddressKey=address_keys(geo_mapping_df['Address']))
+    geo_mapping_df = geo_mapping_df.dropna(subset=['AddressKey']).drop_duplicates('AddressKey')
     con.register("geo_mapping_df", geo_mapping_df)
 
+    # Month key computed in SQL; rows with unparseable dates are dropped
+    con.execute("""
+        CREATE OR REPLACE TEMP VIEW fuel_src AS
+        SELECT *, CAST(date_trunc('month', TRY_CAST(PriceUpdatedDate AS TIMESTAMP)) AS DATE) AS fuel_date
+        FROM fuel_input
+        WHERE TRY_CAST(PriceUpdatedDate AS TIMESTAMP) IS NOT NULL
+    """)
+
     # Insert into FUEL_DETAILS
     con.execute("""
         INSERT INTO FUEL_DETAILS (FuelCode, FuelType, Sales, Date)
         SELECT FuelCode, FuelType, Sales, Date
         FROM fuel_details_df
+        ON CONFLICT DO UPDATE SET FuelType = excluded.FuelType, Sales = excluded.Sales
     """)
 
+    # Insert into GEO_MAPPING (MatchConfidence only comes with geocoder output)
+    geo_columns = "AddressKey, Address, Latitude, Longitude"
+    if 'MatchConfidence' in geo_mapping_df.columns:
+        geo_columns += ", MatchConfidence"
+    con.execute(f"""
+        INSERT INTO GEO_MAPPING ({geo_columns})
+        SELECT {geo_columns} FROM geo_mapping_df
+        ON CONFLICT (AddressKey) DO UPDATE SET
+            Address = excluded.Address,
+            Latitude = excluded.Latitude,
+            Longitude = excluded.Longitude,
+            MatchConfidence = excluded.MatchConfidence
+    """)
+
+    # Rows whose fuel code or address is missing from the lookup tables, checked
+    # before the placeholder fuel codes below are added
+    flag_foreign_keys(con, 'fuel_src', append=append)
+    if quarantine_file:
+        load_quarantine(con, quarantine_file)
 
-    # Insert into GEO_MAPPING
+    # (fuelcode, month) keys with no sales data, found with a single anti-join
     con.execute("""
-        INSERT INTO GEO_MAPPING
-        SELECT * FROM geo_mapping_df
+        CREATE OR REPLACE TEMP TABLE missing_fuel_keys AS
+        SELECT DISTINCT f.FuelCode, f.fuel_date
+        FROM fuel_src f
+        WHERE NOT EXISTS (
+            SELECT 1 FROM FUEL_DETAILS d
+            WHERE d.FuelCode = f.FuelCode AND d.Date = f.fuel_date
+        )
     """)
+    print("Invalid rows due to missing foreign keys:")
+    print(con.execute("SELECT * FROM missing_fuel_keys ORDER BY ALL").fetchdf())
 
-    # Insert into fuel_data (limit can be adjusted or removed)
+    # Create placeholder rows
     con.execute("""
-        INSERT INTO fuel_data (
-            servicestationname,
-            address,
-            suburb,
-            postcode,
-            brand,
-            fuelcode,
-            fuel_date, 
-            priceupdateddate,
-            price
-        )
-        SELECT servicestationname, address, suburb, postcode, brand, fuelcode, fuel_date, priceupdateddate, price
-        FROM fuel_df
+        INSERT INTO FUEL_DETAILS (FuelCode, FuelType, Sales, Date)
+        SELECT FuelCode, 'UNKNOWN', 0.0, fuel_date
+        FROM missing_fuel_keys
     """)
 
+    changed_months = load_fuel_data(con, append)
+    refresh_price_rollups(con, changed_months if incremental else None)
+    if incremental:
+        # Nothing changed: the first month of the rows that did
+        if changed_months:
+            refresh_price_history(con, datetime.combine(changed_months[0], datetime.min.time()))
+    else:
+        refresh_price_history(con)
+    refresh_station_latest_prices(con)
+    create_lake_view(con)
+
+    con.execute("COMMIT")
     con.close()
+
+    if seen_keys_path:
+        record_loaded_keys(fuel_df, seen_keys_path, replace=not incremental)
+    print(f"Loaded {len(changed_months)} new or changed months")
     print("All schemas and data stored in db/fuelcheck.duckdb")
+    return changed_months
+
+# Add the business-key hashes of the rows just loaded to the seen-key file. A
+# full load, or the first load that records keys, takes them from every row in
+# fuel_data instead, so rows loaded before the keys were kept count as seen.
+def record_loaded_keys(fuel_df, seen_keys_path, replace=False):
+    if replace or not os.path.exists(seen_keys_path):
+        con = duckdb.connect("db/fuelcheck.duckdb", read_only=True)
+        key_columns = ", ".join(f'{col.lower()} AS "{col}"' for col in DEDUP_KEY)
+        key_frame = con.execute(f"SELECT {key_columns} FROM fuel_data").fetchdf()
+        con.close()
+        seen_keys = SeenKeys()
+    else:
+        if isinstance(fuel_df, str) and (fuel_df.endswith('.parquet') or os.path.isdir(fuel_df)):
+            key_frame = pd.read_parquet(fuel_df, columns=DEDUP_KEY)
+        elif isinstance(fuel_df, str):
+            key_frame = pd.read_csv(fuel_df, usecols=DEDUP_KEY)
+        else:
+            key_frame = fuel_df
+        seen_keys = SeenKeys(seen_keys_path)
+    seen_keys.add(row_key_hashes(key_frame))
+    seen_keys.save(seen_keys_path)
+    print(f"{len(seen_keys)} loaded row keys recorded in {seen_keys_path}")
+
+# Apply the rows of fuel_src to the star schema month by month. New brands,
+# fuel codes and stations get surrogate keys first. Months whose row
+# fingerprint matches load_manifest are skipped; for the others, fact rows no
+# longer present are deleted and new rows inserted, so rows that are unchanged
+# keep their station_tracking_id. With append every month in fuel_src is
+# applied, nothing is deleted and the manifest counts and fingerprints of the
+# months are recomputed from their loaded rows.
+def load_fuel_data(con, append=False):
+    source_columns = [col[0].lower() for col in con.execute("SELECT * FROM fuel_src LIMIT 0").description]
+    source_file = "f.source_file" if "source_file" in source_columns else "NULL"
+
+    # Cleaned data carries AddressKey; for older inputs it is computed once per
+    # distinct address
+    if "addresskey" in source_columns:
+        address_key, address_key_join = "CAST(f.addresskey AS BIGINT)", ""
+    else:
+        addresses = con.execute("SELECT DISTINCT address AS address FROM fuel_src WHERE address IS NOT NULL").fetchdf()
+        addresses['address_key'] = address_keys(addresses['address'])
+        con.register("address_key_map", addresses)
+        address_key = "k.address_key"
+        address_key_join = "LEFT JOIN address_key_map k ON k.address = f.address"
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE fuel_stage AS
+        SELECT f.servicestationname, f.address, {address_key} AS address_key, f.suburb,
+               CAST(f.postcode AS INTEGER) AS postcode, f.brand, f.fuelcode,
+               CAST(f.fuel_date AS DATE) AS fuel_date,
+               CAST(f.priceupdateddate AS TIMESTAMP) AS priceupdateddate,
+               CAST(f.price AS FLOAT) AS price,
+               {source_file} AS source_file
+        FROM fuel_src f
+        {address_key_join}
+    """)
+
+    key_columns = ", ".join(FUEL_DATA_KEY)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE stage_months AS
+        SELECT fuel_date AS month,
+               string_agg(DISTINCT source_file, ',') AS source_files,
+               COUNT(*) AS row_count,
+               SUM(CAST(hash({key_columns}) AS HUGEINT)) AS fingerprint
+        FROM fuel_stage
+        GROUP BY fuel_date
+    """)
+    changed_filter = "" if append else """
+        LEFT JOIN load_manifest m ON m.month = s.month
+        WHERE m.month IS NULL OR m.row_count <> s.row_count OR m.fingerprint <> s.fingerprint"""
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE changed_months AS
+        SELECT s.*
+        FROM stage_months s{changed_filter}
+    """)
+
+    # Dimensions: add the brands, fuel codes and stations not seen before
+    con.execute("""
+        INSERT INTO brands
+        SELECT nextval('brand_id_seq'), brand
+        FROM (SELECT DISTINCT brand FROM fuel_stage WHERE brand IS NOT NULL) new_brands
+        WHERE brand NOT IN (SELECT brand FROM brands)
+    """)
+    con.execute("""
+        INSERT INTO fuel_codes
+        SELECT nextval('fuel_id_seq'), fuelcode
+        FROM (SELECT DISTINCT fuelcode FROM fuel_stage WHERE fuelcode IS NOT NULL) new_codes
+        WHERE fuelcode NOT IN (SELECT fuelcode FROM fuel_codes)
+    """)
+    station_match = " AND ".join(
+        f"t.{col} IS NOT DISTINCT FROM s.{col}" for col in STATION_KEY
+    )
+    con.execute(f"""
+        INSERT INTO stations
+        SELECT nextval('station_key_seq'), servicestationname, address, address_key, suburb, postcode, brand_id
+        FROM (
+            SELECT DISTINCT f.servicestationname, f.address, f.address_key, f.suburb, f.postcode, b.brand_id
+            FROM fuel_stage f
+            LEFT JOIN brands b ON b.brand = f.brand
+        ) s
+        WHERE NOT EXISTS (SELECT 1 FROM stations t WHERE {station_match})
+    """)
+
+    # Stage rows resolved to surrogate keys, limited to the months being applied
+    stage_station_match = " AND ".join(
+        f"t.{col} IS NOT DISTINCT FROM f.{col}" for col in STATION_KEY if col != 'brand_id'
+    ) + " AND t.brand_id IS NOT DISTINCT FROM b.brand_id"
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE fact_stage AS
+        SELECT t.station_id, c.fuel_id, f.priceupdateddate, f.price
+        FROM fuel_stage f
+        LEFT JOIN brands b ON b.brand = f.brand
+        LEFT JOIN fuel_codes c ON c.fuelcode = f.fuelcode
+        JOIN stations t ON {stage_station_match}
+        WHERE f.fuel_date IN (SELECT month FROM changed_months)
+    """)
+
+    fact_match = " AND ".join(f"t.{col} IS NOT DISTINCT FROM s.{col}" for col in FACT_KEY)
+    if not append:
+        con.execute(f"""
+            DELETE FROM fuel_prices t
+            WHERE CAST(date_trunc('month', t.priceupdateddate) AS DATE) IN (SELECT month FROM changed_months)
+              AND NOT EXISTS (SELECT 1 FROM fact_stage s WHERE {fact_match})
+        """)
+    con.execute(f"""
+        INSERT INTO fuel_prices (station_id, fuel_id, priceupdateddate, price)
+        SELECT station_id, fuel_id, priceupdateddate, price
+        FROM fact_stage s
+        WHERE NOT EXISTS (SELECT 1 FROM fuel_prices t WHERE {fact_match})
+    """)
+
+    if append:
+        # Staged rows already loaded were not inserted, so the counts and
+        # fingerprints of the touched months are taken from the loaded rows
+        con.execute(f"""
+            INSERT INTO load_manifest
+            SELECT c.month, c.source_files, t.row_count, t.fingerprint, now()
+            FROM changed_months c
+            JOIN (
+                SELECT fuel_date AS month, COUNT(*) AS row_count,
+                       SUM(CAST(hash({key_columns}) AS HUGEINT)) AS fingerprint
+                FROM fuel_data
+                WHERE fuel_date IN (SELECT month FROM changed_months)
+                GROUP BY fuel_date
+            ) t ON t.month = c.month
+            ON CONFLICT (month) DO UPDATE SET
+                source_files = CASE WHEN contains(load_manifest.source_files, excluded.source_files)
+                                    THEN load_manifest.source_files
+                                    ELSE load_manifest.source_files || ',' || excluded.source_files END,
+                row_count = excluded.row_count,
+                fingerprint = excluded.fingerprint,
+                loaded_at = excluded.loaded_at
+        """)
+    else:
+        con.execute("""
+            INSERT OR REPLACE INTO load_manifest
+            SELECT month, source_files, row_count, fingerprint, now()
+            FROM changed_months
+        """)
+
+    changed_months = [row[0] for row in con.execute("SELECT month FROM changed_months ORDER BY month").fetchall()]
+    con.execute("DROP TABLE fuel_stage")
+    con.execute("DROP TABLE fact_stage")
+    return changed_months
 
 
 def test_fuel_data_queries():
@@ -153,26 +480,26 @@ def test_fuel_data_queries():
 
     con = duckdb.connect("db/fuelcheck.duckdb")
 
-    # Show all rows from fuel_data (or limited if necessary)
-    print("All rows from fuel_data:")
-    df_all_data = con.execute("SELECT * FROM fuel_data").fetchdf()
-    print(df_all_data)
+    # Show all rows from fuel_data (diagnostics only: materialises the whole table)
+    if verbose(2):
+        print("All rows from fuel_data:")
+        df_all_data = con.execute("SELECT * FROM fuel_data").fetchdf()
+        print(df_all_data)
 
     # Count total records
     total = con.execute("SELECT COUNT(*) AS total_rows FROM fuel_data").fetchone()[0]
     print(f"\nTotal rows in fuel_data: {total}")
 
-    # Example: Get average price per fuel type
+    con.close()
+
+    # Example: Get average price per fuel type (served from the rollup tables)
     print("\nAverage price per fuel type:")
-    avg_price = con.execute(
-        """
-        SELECT fuelcode, AVG(price) AS avg_price
-        FROM fuel_data
-        GROUP BY fuelcode
-        ORDER BY avg_price DESC
-        LIMIT 10
-    """
-    ).fetchdf()
+    avg_price = average_price_by_fuelcode()[['fuelcode', 'avg_price']].head(10)
     print(avg_price)
 
-    con.close()
+    # Example: scan one fuel code of the price lake, without the DuckDB file
+    if lake_exists(PRICE_LAKE_DIR):
+        print("\nE10 prices per month from the price lake:")
+        e10 = lake_prices('E10', columns='year, month, Price')
+        print(e10.groupby(['year', 'month'])['Price'].agg(['count', 'mean']))
+    return total
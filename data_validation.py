@@ -0,0 +1,295 @@
+import os
+import pandas as pd
+import numpy as np
+
+# Rows rejected while cleaning, with the rules they failed; store loads them
+# into the quarantine table
+QUARANTINE_FILE = 'quarantined_fuelcheck_data.parquet'
+# Columns of the price rows kept in the quarantine, as text (a rejected value
+# may not fit the column's type)
+QUARANTINE_COLUMNS = ['source_file', 'ServiceStationName', 'Address', 'Suburb', 'Postcode', 'Brand',
+                      'FuelCode', 'PriceUpdatedDate', 'Price']
+# Separator of the rule names in RejectReasons
+REASON_SEPARATOR = ';'
+# Text that stands for a missing date in the monthly exports (rules opt in
+# with markers=MISSING_MARKERS)
+MISSING_MARKERS = ['', '--', '-', 'null', 'n/a', 'na', 'nan', 'none', '0']
+# Dates are parsed when the monthly files are read (see
+# data_retrieval.parse_price_dates); a value that is present but is not a date
+# becomes this timestamp, so the date_parse rule can still reject it
+UNPARSEABLE_DATE = pd.Timestamp('1800-01-01')
+
+# One check on one column. check is a key of RULE_CHECKS and params are its
+# arguments: values for allowed_values, min/max for range, table, ref_column
+# and an optional ref_filter (SQL condition on the table) for foreign_key.
+# markers, for any check, lists text that counts as a missing value
+# (compared stripped and lower-cased); otherwise only nulls are missing. A
+# failing 'reject' rule removes the row; a 'flag' rule only counts it.
+class Rule:
+    def __init__(self, name, column, check, action='reject', **params):
+        if check not in RULE_CHECKS:
+            raise ValueError(f"Unknown check {check!r} for rule {name!r}")
+        self.name = name
+        self.column = column
+        self.check = check
+        self.action = action
+        self.params = params
+
+    def __repr__(self):
+        return f"Rule({self.name!r}, {self.column!r}, {self.check!r}, action={self.action!r})"
+
+# Values derived from a column on first use and shared by all its rules, so the
+# column is scanned once per derivation however many rules read it
+class ColumnValues:
+    def __init__(self, values):
+        self.values = values
+        self._missing = {}
+        self._numbers = None
+        self._dates = None
+
+    # Missing rows: nulls, and text in markers; kept per set of markers
+    def missing(self, markers=()):
+        key = tuple(markers)
+        if key not in self._missing:
+            values = self.values
+            missing = values.isna().to_numpy()
+            if markers and isinstance(values.dtype, pd.CategoricalDtype):
+                # Once per category rather than once per row
+                marker_categories = values.cat.categories.astype(str).str.strip().str.lower().isin(markers)
+                codes = values.cat.codes.to_numpy()
+                missing |= (codes >= 0) & marker_categories[np.maximum(codes, 0)]
+            elif markers and (values.dtype == object or pd.api.types.is_string_dtype(values.dtype)):
+                missing |= values.str.strip().str.lower().isin(markers).to_numpy()
+            self._missing[key] = missing
+        return self._missing[key]
+
+    @property
+    def numbers(self):
+        if self._numbers is None:
+            self._numbers = pd.to_numeric(self.values, errors='coerce')
+        return self._numbers
+
+    @property
+    def dates(self):
+        if self._dates is None:
+            if pd.api.types.is_datetime64_any_dtype(self.values.dtype):
+                self._dates = self.values.mask(self.values == UNPARSEABLE_DATE)
+            else:
+                self._dates = pd.to_datetime(self.values, errors='coerce')
+        return self._dates
+
+# Each check returns the failing rows as a boolean array. Only not_null fails
+# on a missing value; the others leave missing values to it.
+def _check_not_null(column, rule, references):
+    return column.missing(rule.params.get('markers', ()))
+
+def _check_allowed_values(column, rule, references):
+    return ~column.missing(rule.params.get('markers', ())) & ~column.values.isin(rule.params['values']).to_numpy()
+
+def _check_range(column, rule, references):
+    numbers = column.numbers
+    failed = numbers.isna().to_numpy()
+    if rule.params.get('min') is not None:
+        failed |= (numbers < rule.params['min']).to_numpy()
+    if rule.params.get('max') is not None:
+        failed |= (numbers > rule.params['max']).to_numpy()
+    return ~column.missing(rule.params.get('markers', ())) & failed
+
+def _check_date_parse(column, rule, references):
+    return ~column.missing(rule.params.get('markers', ())) & column.dates.isna().to_numpy()
+
+# references maps 'TABLE.column' to the values present there; without an entry
+# the rule is not evaluated (fails no rows)
+def _check_foreign_key(column, rule, references):
+    reference = (references or {}).get(f"{rule.params['table']}.{rule.params['ref_column']}")
+    if reference is None:
+        return np.zeros(len(column.values), dtype=bool)
+    return ~column.missing(rule.params.get('markers', ())) & ~column.values.isin(reference).to_numpy()
+
+RULE_CHECKS = {
+    'not_null': _check_not_null,
+    'allowed_values': _check_allowed_values,
+    'range': _check_range,
+    'date_parse': _check_date_parse,
+    'foreign_key': _check_foreign_key,
+}
+
+# Rules for a cleaned month. The row rules run in clean_partition; the foreign
+# keys need the loaded lookup tables and are checked by flag_foreign_keys
+# during the load, where rows are flagged rather than rejected (FUEL_DETAILS
+# gets placeholder rows and prices without a geocoded address still load).
+FUELCHECK_RULES = [
+    Rule('station_name_missing', 'ServiceStationName', 'not_null'),
+    Rule('price_missing', 'Price', 'not_null'),
+    Rule('price_out_of_range', 'Price', 'range', min=50, max=300),
+    Rule('date_missing', 'PriceUpdatedDate', 'not_null', markers=MISSING_MARKERS),
+    Rule('date_unparseable', 'PriceUpdatedDate', 'date_parse', markers=MISSING_MARKERS),
+    # Placeholder rows added for unknown codes by earlier loads do not count
+    Rule('fuelcode_unknown', 'FuelCode', 'foreign_key', action='flag', table='FUEL_DETAILS', ref_column='FuelCode',
+         ref_filter="FuelType <> 'UNKNOWN'"),
+    Rule('address_not_geocoded', 'AddressKey', 'foreign_key', action='flag',
+         table='GEO_MAPPING', ref_column='AddressKey'),
+]
+
+# Outcome of validate: rejected is a boolean array over the rows, reasons the
+# failed rule names of each rejected row, counts the failing rows per rule,
+# and parsed the numbers/dates derived from each column (for reuse)
+class ValidationResult:
+    def __init__(self, rejected, reasons, counts, parsed):
+        self.rejected = rejected
+        self.reasons = reasons
+        self.counts = counts
+        self.parsed = parsed
+
+# Run the rules over df in one pass per column: every rule of a column reads
+# the same derived values, and the failures of all rules are kept as one bit
+# mask per row. Rules on columns df does not have are skipped.
+def validate(df, rules=FUELCHECK_RULES, references=None):
+    failed_bits = np.zeros(len(df), dtype=np.uint64)
+    reject_bits = np.uint64(0)
+    counts = {}
+    parsed = {}
+    rules_by_column = {}
+    for bit, rule in enumerate(rules):
+        rules_by_column.setdefault(rule.column, []).append((bit, rule))
+
+    for column_name, column_rules in rules_by_column.items():
+        if column_name not in df.columns:
+            continue
+        column = ColumnValues(df[column_name])
+        for bit, rule in column_rules:
+            failed = RULE_CHECKS[rule.check](column, rule, references)
+            counts[rule.name] = int(failed.sum())
+            if counts[rule.name]:
+                failed_bits[failed] |= np.uint64(1 << bit)
+            if rule.action == 'reject':
+                reject_bits |= np.uint64(1 << bit)
+        if column._dates is not None:
+            parsed[column_name] = column._dates
+        elif column._numbers is not None:
+            parsed[column_name] = column._numbers
+
+    rejected = (failed_bits & reject_bits) != 0
+    # Reason text per distinct failure pattern, not per row
+    patterns, inverse = np.unique(failed_bits[rejected], return_inverse=True)
+    pattern_reasons = np.array([
+        REASON_SEPARATOR.join(rule.name for bit, rule in enumerate(rules) if int(pattern) >> bit & 1)
+        for pattern in patterns
+    ], dtype=object)
+    reasons = pd.Series(pattern_reasons[inverse] if len(patterns) else [], index=df.index[rejected], dtype=object)
+    return ValidationResult(rejected, reasons, counts, parsed)
+
+# The rejected rows of a validated frame as text, with their reasons
+def quarantine_rows(df, result):
+    rows = df.loc[result.rejected, [col for col in QUARANTINE_COLUMNS if col in df.columns]]
+    rows = rows.astype('string')
+    rows['RejectReasons'] = result.reasons.astype('string')
+    return rows
+
+# Rejected rows per rule, from the RejectReasons of quarantined rows
+def rule_counts(rows):
+    if rows is None or rows.empty:
+        return {}
+    counts = rows['RejectReasons'].str.split(REASON_SEPARATOR).explode().value_counts()
+    return {name: int(count) for name, count in counts.items()}
+
+# Write the quarantined rows of a run (a list of frames from quarantine_rows)
+# to one Parquet file, empty if nothing was rejected. Returns the rejected
+# rows per rule.
+def save_quarantine(frames, path=QUARANTINE_FILE):
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if frames:
+        rows = pd.concat(frames, ignore_index=True)
+    else:
+        rows = pd.DataFrame({col: pd.Series(dtype='string') for col in QUARANTINE_COLUMNS + ['RejectReasons']})
+    tmp_file = path + '.tmp'
+    rows.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, path)
+    counts = rule_counts(rows)
+    print(f"Quarantined {len(rows)} rows to {path}")
+    for name, count in counts.items():
+        print(f"  {name}: {count}")
+    return counts
+
+# Quarantined rows of an earlier run from the given source files, carried over
+# when only some monthly files are cleaned again
+def read_quarantine(path=QUARANTINE_FILE, sources=()):
+    if not sources or not os.path.exists(path):
+        return None
+    return pd.read_parquet(path, filters=[('source_file', 'in', sorted(sources))])
+
+def create_quarantine_table(con):
+    column_defs = ",\n            ".join(f"{col.lower()} VARCHAR" for col in QUARANTINE_COLUMNS)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS quarantine (
+            {column_defs},
+            reasons VARCHAR[],
+            action VARCHAR,
+            quarantined_at TIMESTAMP
+        );
+    """)
+
+def _quarantine_select(available_columns):
+    available = {col.lower() for col in available_columns}
+    return ", ".join(
+        f'CAST("{col}" AS VARCHAR)' if col.lower() in available else "NULL"
+        for col in QUARANTINE_COLUMNS
+    )
+
+# Replace the rejected rows in the quarantine table with those of the file.
+# Cleaning validates every monthly file on each run, so the file always holds
+# the full set.
+def load_quarantine(con, path=QUARANTINE_FILE):
+    create_quarantine_table(con)
+    con.execute("DELETE FROM quarantine WHERE action = 'rejected'")
+    if not os.path.exists(path):
+        return 0
+    columns = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM read_parquet({path!r})").fetchall()]
+    con.execute(f"""
+        INSERT INTO quarantine
+        SELECT {_quarantine_select(columns)},
+               string_split(RejectReasons, '{REASON_SEPARATOR}'), 'rejected', current_localtimestamp()
+        FROM read_parquet({path!r})
+    """)
+    return con.execute("SELECT COUNT(*) FROM quarantine WHERE action = 'rejected'").fetchone()[0]
+
+# Check the foreign_key rules against the lookup tables in one scan of source
+# (a table or view of price rows): each row is tested against every reference
+# and rows failing any are added to the quarantine as 'flagged' with the rules
+# they failed. The flags of earlier loads are replaced unless append (source
+# then only holds new rows). Returns the flagged rows per rule.
+def flag_foreign_keys(con, source='fuel_src', rules=FUELCHECK_RULES, append=False):
+    create_quarantine_table(con)
+    if not append:
+        con.execute("DELETE FROM quarantine WHERE action = 'flagged'")
+    columns = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+    available = {col.lower() for col in columns}
+    key_rules = [rule for rule in rules if rule.check == 'foreign_key' and rule.column.lower() in available]
+    if not key_rules:
+        return {}
+
+    failures = ", ".join(
+        f"""CASE WHEN s."{rule.column}" IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM {rule.params['table']} r
+                WHERE r."{rule.params['ref_column']}" = s."{rule.column}" AND ({rule.params.get('ref_filter') or 'true'})
+            ) THEN '{rule.name}' END"""
+        for rule in key_rules
+    )
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE flagged_rows AS
+        SELECT * FROM (
+            SELECT {_quarantine_select(columns)},
+                   list_filter([{failures}], reason -> reason IS NOT NULL) AS reasons
+            FROM {source} s
+        )
+        WHERE len(reasons) > 0
+    """)
+    con.execute("INSERT INTO quarantine SELECT *, 'flagged', current_localtimestamp() FROM flagged_rows")
+    counts = dict(con.execute("""
+        SELECT reason, COUNT(*) FROM (SELECT unnest(reasons) AS reason FROM flagged_rows)
+        GROUP BY reason ORDER BY reason
+    """).fetchall())
+    con.execute("DROP TABLE flagged_rows")
+    for name, count in counts.items():
+        print(f"Flagged {count} rows: {name}")
+    return counts
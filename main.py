@@ -1,90 +1,439 @@
-from data_retrieval import *
-from data_integration import *
-from data_augmentation import *
-from data_transformation import *
+# Command line entry point: `python main.py <command>`, see main() below. Each
+# command imports the modules it needs when it runs, so a query does not pay
+# for pandas, requests or geopy.
+import argparse
+import json
+import os
+import sys
 
-# convert csv to text
-def convert_csv_to_txt_and_cleanup(folder_path='data'):
+# Number of worker processes for parsing and cleaning; 1 keeps the serial path
+CLEANING_WORKERS = int(os.environ.get('CLEANING_WORKERS', '1'))
+# Streaming mode cleans and exports the data chunk by chunk with bounded memory
+STREAM_MODE = os.environ.get('STREAM_MODE', '0') == '1'
+# Incremental load keeps the DuckDB tables and only applies new or changed months
+INCREMENTAL_LOAD = os.environ.get('INCREMENTAL_LOAD', '0') == '1'
+# Drop rows whose business key is already loaded (see data_integration.SeenKeys)
+# while cleaning, and append the rest to DuckDB; needs INCREMENTAL_LOAD. The
+# cleaned outputs then only hold the new rows. The first run records the keys.
+SKIP_LOADED_ROWS = os.environ.get('SKIP_LOADED_ROWS', '0') == '1'
+# Clean only the monthly files that are new or changed since the last clean and
+# keep the earlier cleaned rows of the others (not in STREAM_MODE, whose CSV
+# output does not record the source files)
+CLEAN_CHANGED_ONLY = os.environ.get('CLEAN_CHANGED_ONLY', '0') == '1'
+# Resolve addresses from the bundled reference data and the geocode cache only,
+# leaving the rest ungeocoded instead of sending them to Nominatim
+OFFLINE_GEOCODING = os.environ.get('OFFLINE_GEOCODING', '0') == '1'
+# Comma-separated stages to run even when their inputs are unchanged ('all' for every stage)
+FORCE_STAGES = [name for name in os.environ.get('FORCE_STAGES', '').split(',') if name]
+
+# Files passed between the pipeline stages (the monthly file list is
+# data_retrieval.MONTHLY_FILES_MANIFEST)
+CLEANED_CSV = 'cleaned_fuelcheck_data.csv'
+CLEANED_PARQUET = 'cleaned_fuelcheck_data.parquet'
+PRODUCT_SALES_CSV = 'data/ProductSales - Sheet1.csv'
+# Built from the product sales; the bundled data/fuel.txt is not rewritten
+FUEL_CSV = 'db/fuel.csv'
+# Geocoder output; the bundled results in data/ are only read
+GEOCODED_ADDRESSES_CSV = 'db/unique_addresses_with_lat_lng.csv'
+BUNDLED_GEOCODED_ADDRESSES_CSV = 'data/unique_addresses_with_lat_lng.csv'
+BUNDLED_GEO_MAPPING_CSV = 'data/fuel_prices_with_lat_lng.csv'
+DUCKDB_FILE = 'db/fuelcheck.duckdb'
+
+# Reference files are read under either extension (see resolve_data_file), so
+# the pipeline no longer converts the data directory. These remain for anyone
+# who wants the files under one extension; they only rename, and each rename
+# is atomic, so an interrupted run never leaves a half-written file.
+def rename_data_files(folder_path, from_extension, to_extension):
     # check if folder exist
     if not os.path.exists(folder_path):
         print(f"Folder '{folder_path}' does not exist.")
         return
 
     for filename in os.listdir(folder_path):
-        if filename.endswith('.csv'):
-            csv_path = os.path.join(folder_path, filename)
-            txt_filename = filename.replace('.csv', '.txt')
-            txt_path = os.path.join(folder_path, txt_filename)
-
-            # read csv
-            with open(csv_path, 'r', encoding='utf-8') as csv_file:
-                content = csv_file.read()
-
-            with open(txt_path, 'w', encoding='utf-8') as txt_file:
-                txt_file.write(content)
+        if filename.endswith(from_extension):
+            source_path = os.path.join(folder_path, filename)
+            target_path = source_path[:-len(from_extension)] + to_extension
+            os.replace(source_path, target_path)
+            print(f"Renamed: {filename} -> {os.path.basename(target_path)}")
 
-            # remove csv
-            os.remove(csv_path)
-            print(f"Converted and deleted: {filename}")
+# convert csv to text
+def convert_csv_to_txt_and_cleanup(folder_path='data'):
+    rename_data_files(folder_path, '.csv', '.txt')
 
 # convert txt to csv
 def convert_txt_to_csv_and_cleanup(folder_path='data'):
-    if not os.path.exists(folder_path):
-        print(f"Folder '{folder_path}' does not exist.")
-        return
+    rename_data_files(folder_path, '.txt', '.csv')
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.txt'):
-            txt_path = os.path.join(folder_path, filename)
-            csv_filename = filename.replace('.txt', '.csv')
-            csv_path = os.path.join(folder_path, csv_filename)
+# (link, path) of every monthly file of the last retrieval, or of those that
+# were new or changed in it
+def read_monthly_files(changed=False):
+    from data_retrieval import MONTHLY_FILES_MANIFEST
+    with open(MONTHLY_FILES_MANIFEST, encoding='utf-8') as f:
+        manifest = json.load(f)
+    # Older manifests are the plain list of files
+    if isinstance(manifest, list):
+        manifest = {'files': manifest, 'changed': manifest}
+    return [tuple(entry) for entry in manifest['changed' if changed else 'files']]
 
-            with open(txt_path, 'r', encoding='utf-8') as txt_file:
-                content = txt_file.read()
+# The pipeline as stages that hand over files. Retrieval always runs (one
+# catalog request plus downloads of new files); everything after it only
+# re-runs when the files it reads or its code changed. fuel_details has no
+# dependencies and geocoding only needs the cleaned CSV, so they run alongside
+# the other stages. only names the stages to build (all by default); each
+# stage's modules are imported when it is built, and dependencies on stages
+# that are not built are dropped (their outputs are expected on disk).
+def build_stages(cleaning_workers=CLEANING_WORKERS, stream=STREAM_MODE, incremental=INCREMENTAL_LOAD,
+                 skip_loaded=SKIP_LOADED_ROWS, only=None, changed_only=CLEAN_CHANGED_ONLY,
+                 offline_geocoding=OFFLINE_GEOCODING):
+    from pipeline import Stage
+    cleaned_output = CLEANED_CSV if stream else CLEANED_PARQUET
+    skip_loaded = skip_loaded and incremental
+    stages = []
 
-            with open(csv_path, 'w', encoding='utf-8') as csv_file:
-                csv_file.write(content)
+    def wanted(name):
+        return only is None or name in only
 
-            os.remove(txt_path)
-            print(f"Converted and deleted: {filename}")
+    # Rows are only skipped once a load has recorded its keys; clean and store
+    # both check this, and only store changes the answer
+    def append_new_rows():
+        from data_integration import SEEN_KEYS_PATH
+        return skip_loaded and os.path.exists(SEEN_KEYS_PATH) and os.path.exists(DUCKDB_FILE)
 
+    #Step 1: Retrieving the data
+    if wanted('retrieve'):
+        import data_catalog
+        import data_retrieval
 
-def main():
-    # Convert All txt files to csv
-    convert_txt_to_csv_and_cleanup()
+        def retrieve():
+            changed = []
+            monthly_files = data_retrieval.fetch_monthly_files(changes=changed)
+            tmp_file = data_retrieval.MONTHLY_FILES_MANIFEST + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'files': monthly_files, 'changed': changed}, f, indent=2)
+            os.replace(tmp_file, data_retrieval.MONTHLY_FILES_MANIFEST)
+            data_retrieval.prune_parsed_cache()
+            return {'files': len(monthly_files), 'files_changed': len(changed)}
 
-    #Step 1: Retrieving the data
-    fuelcheck_raw_data = retrieve_fuelcheck_monthly_data()
-    print("Raw Data", fuelcheck_raw_data)
-    test_retrieve_fuelcheck_monthly_data(fuelcheck_raw_data) 
+        stages.append(Stage('retrieve', retrieve, outputs=[data_retrieval.MONTHLY_FILES_MANIFEST],
+                            code=[data_retrieval, data_catalog], always_run=True))
 
     #Step 2: Data Cleaning
-    fuelcheck_clean_data = data_cleaning(fuelcheck_raw_data)
+    if wanted('clean'):
+        import data_addresses
+        import data_catalog
+        import data_integration
+        import data_retrieval
+        import data_validation
+        from metrics import verbose
+
+        def clean():
+            import pandas as pd
+            monthly_files = read_monthly_files()
+            appending = append_new_rows()
+            seen_keys = data_integration.SeenKeys(data_integration.SEEN_KEYS_PATH) if appending else None
+            # Rows failing validation, with their reasons, for the quarantine table
+            quarantine = []
+            if stream:
+                # Clean and export the files chunk by chunk
+                data_integration.stream_clean_to_csv(monthly_files, CLEANED_CSV, seen_keys=seen_keys,
+                                                     quarantine=quarantine)
+                return {'rows_rejected': sum(len(rows) for rows in quarantine),
+                        'rows_rejected_by_rule': data_validation.save_quarantine(quarantine,
+                                                                                 data_validation.QUARANTINE_FILE)}
+            counts = {}
+            # Changed-only cleaning keeps the earlier cleaned and quarantined
+            # rows of the files it does not clean again. When only new rows are
+            # appended the earlier rows were loaded already, so only their
+            # rejects are kept.
+            files_to_clean, kept, kept_quarantine = None, None, None
+            if changed_only and os.path.exists(data_validation.QUARANTINE_FILE):
+                files_to_clean = data_integration.split_changed_files(
+                    CLEANED_PARQUET, monthly_files, read_monthly_files(changed=True))
+            if files_to_clean is None:
+                files_to_clean = monthly_files
+            else:
+                kept_links = {link for link, _ in monthly_files} - {link for link, _ in files_to_clean}
+                kept_quarantine = data_validation.read_quarantine(data_validation.QUARANTINE_FILE, kept_links)
+                kept = data_integration.read_cleaned_rows(CLEANED_PARQUET, set() if appending else kept_links)
+                print(f"Cleaning {len(files_to_clean)} of {len(monthly_files)} monthly files")
+            counts['files_cleaned'] = len(files_to_clean)
+            if not files_to_clean:
+                fuelcheck_clean_data = pd.DataFrame()
+            elif cleaning_workers > 1:
+                # Parse and clean each month in parallel
+                fuelcheck_clean_data = data_integration.clean_monthly_files_parallel(
+                    files_to_clean, max_workers=cleaning_workers, seen_keys=seen_keys, quarantine=quarantine)
+            else:
+                fuelcheck_raw_data = data_retrieval.retrieve_fuelcheck_monthly_data(files_to_clean)
+                counts['rows_in'] = len(fuelcheck_raw_data)
+                if verbose(2):
+                    print("Raw Data", fuelcheck_raw_data)
+                    data_retrieval.test_retrieve_fuelcheck_monthly_data(fuelcheck_raw_data)
+                fuelcheck_clean_data = data_integration.data_cleaning(fuelcheck_raw_data, seen_keys, quarantine)
+            if kept is not None:
+                fuelcheck_clean_data = data_integration.merge_cleaned_rows(kept, fuelcheck_clean_data, monthly_files)
+            # Parquet for the DuckDB load
+            data_integration.convert_cleaned_data_to_parquet(fuelcheck_clean_data, CLEANED_PARQUET, monthly_files)
+            # Rejected rows in the quarantine file, in total and per rule
+            quarantine = [kept_quarantine] + quarantine
+            counts['rows_rejected_by_rule'] = data_validation.save_quarantine(quarantine,
+                                                                              data_validation.QUARANTINE_FILE)
+            counts['rows_out'] = len(fuelcheck_clean_data)
+            counts['rows_rejected'] = sum(len(rows) for rows in quarantine if rows is not None)
+            return counts
+
+        stages.append(Stage(
+            'clean', clean,
+            inputs=lambda: [path for _, path in read_monthly_files()]
+                           + ([data_integration.SEEN_KEYS_PATH] if skip_loaded else []),
+            outputs=[cleaned_output, data_validation.QUARANTINE_FILE], after=['retrieve'],
+            code=[data_retrieval, data_integration, data_addresses, data_catalog, data_validation],
+            params={'stream': stream, 'skip_loaded': skip_loaded, 'changed_only': changed_only}))
 
     #Save the cleaned data to CSV
-    convert_cleaned_data_to_csv(fuelcheck_clean_data) 
+    if wanted('export') and not stream:
+        import data_integration
+
+        def export():
+            import pandas as pd
+            fuelcheck_clean_data = pd.read_parquet(CLEANED_PARQUET)
+            data_integration.convert_cleaned_data_to_csv(fuelcheck_clean_data)
+            return {'rows_in': len(fuelcheck_clean_data), 'rows_out': len(fuelcheck_clean_data)}
+
+        stages.append(Stage('export', export, inputs=[CLEANED_PARQUET], outputs=[CLEANED_CSV],
+                            after=['clean'], code=[data_integration]))
+
+    # Partitioned Parquet copy of the cleaned rows (year/month/fuel code). When
+    # rows already loaded are skipped, the cleaned output only holds new rows,
+    # so they are merged into the months already in the lake.
+    if wanted('lake'):
+        import data_integration
+        import data_lake
+
+        def lake():
+            months = data_lake.write_price_lake(cleaned_output, merge=skip_loaded)
+            return {'months': len(months)}
+
+        stages.append(Stage('lake', lake, inputs=[cleaned_output], outputs=[data_lake.PRICE_LAKE_DIR],
+                            after=['clean'], code=[data_lake, data_integration],
+                            params={'skip_loaded': skip_loaded}))
 
     # Step 3: Data Augmentation
-    # This will only run when additional dataset files will not exist 
+    if wanted('fuel_details') or wanted('geocode') or wanted('store'):
+        import data_augmentation
+        # Generated augmentation outputs (under db/)
+        fuel_csv = FUEL_CSV
+        geocoded_addresses_csv = GEOCODED_ADDRESSES_CSV
+
     # Make Fuel Table
-    fuel_details()
+    if wanted('fuel_details'):
+        product_sales_csv = data_augmentation.resolve_data_file(PRODUCT_SALES_CSV)
 
-    # Make Geo Mapping Table
-    geocode_unique_addresses()
+        def make_fuel_details():
+            data_augmentation.fuel_details(fuel_csv, overwrite=True)
 
-    # Step 4: Data Transformation and Storage
-    # fetch fuel data
-    fuel = pd.read_csv("data/fuel.csv")
-    # fetch geo mapping data
-    mapping = pd.read_csv("data/fuel_prices_with_lat_lng.csv")
-    # Transform and store data into duckdb
-    store_to_duckdb(fuelcheck_clean_data, fuel, mapping)
+        stages.append(Stage('fuel_details', make_fuel_details, inputs=[product_sales_csv], outputs=[fuel_csv],
+                            code=[data_augmentation]))
+
+    # Make Geo Mapping Table. When rows already loaded are skipped the cleaned
+    # CSV only holds new rows, so their addresses are merged into the output.
+    if wanted('geocode'):
+        import data_addresses
+        reference_files = [data_augmentation.resolve_data_file(path) for path in
+                           data_augmentation.OFFLINE_REFERENCE_FILES + [data_augmentation.STATION_REGISTER_FILE]]
+
+        def geocode():
+            data_augmentation.geocode_unique_addresses(CLEANED_CSV, geocoded_addresses_csv, merge=skip_loaded,
+                                                       network=not offline_geocoding)
+
+        stages.append(Stage('geocode', geocode, inputs=[CLEANED_CSV] + reference_files,
+                            outputs=[geocoded_addresses_csv], after=['clean' if stream else 'export'],
+                            code=[data_augmentation, data_addresses],
+                            params={'skip_loaded': skip_loaded, 'offline_geocoding': offline_geocoding}))
+
+    # Step 4: Data Transformation and Storage. Runs after the lake so the
+    # fuel_lake view it creates finds the lake files.
+    if wanted('store'):
+        import data_addresses
+        import data_analytics
+        import data_history
+        import data_integration
+        import data_lake
+        import data_spatial
+        import data_transformation
+        import data_validation
+        bundled_geocoded_addresses_csv = data_augmentation.resolve_data_file(BUNDLED_GEOCODED_ADDRESSES_CSV)
+        bundled_geo_mapping_csv = data_augmentation.resolve_data_file(BUNDLED_GEO_MAPPING_CSV)
+
+        def store():
+            import pandas as pd
+            # fetch fuel data
+            fuel = pd.read_csv(fuel_csv)
+            # fetch geo mapping data: geocoder output (with match confidence) first,
+            # then the bundled results for any address it does not cover
+            mapping = pd.concat([
+                pd.read_csv(path) for path in
+                [geocoded_addresses_csv, bundled_geocoded_addresses_csv, bundled_geo_mapping_csv]
+                if os.path.exists(path)
+            ], ignore_index=True).drop_duplicates(subset=['Address'])
+            # Transform and store data into duckdb
+            data_transformation.store_to_duckdb(
+                cleaned_output, fuel, mapping, incremental=incremental, append=append_new_rows(),
+                seen_keys_path=data_integration.SEEN_KEYS_PATH if skip_loaded else None,
+                quarantine_file=data_validation.QUARANTINE_FILE)
+
+        stages.append(Stage(
+            'store', store,
+            inputs=[cleaned_output, data_validation.QUARANTINE_FILE, fuel_csv, geocoded_addresses_csv,
+                    bundled_geocoded_addresses_csv, bundled_geo_mapping_csv],
+            outputs=[DUCKDB_FILE], after=['clean', 'lake', 'fuel_details', 'geocode'],
+            code=[data_transformation, data_analytics, data_spatial, data_history, data_addresses, data_integration,
+                  data_lake, data_validation],
+            params={'incremental': incremental, 'skip_loaded': skip_loaded}))
 
     # get data to test if data is properly uploaded
-    test_fuel_data_queries()
+    if wanted('verify'):
+        import data_analytics
+        import data_lake
+        import data_transformation
+
+        def verify():
+            return {'rows_out': data_transformation.test_fuel_data_queries()}
+
+        stages.append(Stage('verify', verify, inputs=[DUCKDB_FILE], after=['store', 'lake'],
+                            code=[data_transformation, data_analytics, data_lake]))
+
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        stage.after = [name for name in stage.after if name in names]
+    return stages
+
+def run_stages(only=None, cleaning_workers=CLEANING_WORKERS, stream=STREAM_MODE, incremental=INCREMENTAL_LOAD,
+               skip_loaded=SKIP_LOADED_ROWS, force=FORCE_STAGES, changed_only=CLEAN_CHANGED_ONLY,
+               offline_geocoding=OFFLINE_GEOCODING):
+    from pipeline import run_pipeline
+    return run_pipeline(build_stages(cleaning_workers, stream, incremental, skip_loaded, only, changed_only,
+                                     offline_geocoding),
+                        force=force)
+
+# Pipeline stages run by each command; 'run' (the default) runs all of them
+PIPELINE_COMMANDS = {
+    'fetch': (['retrieve'], "discover and download the monthly price files"),
+    'clean': (['clean', 'export', 'lake'], "clean the downloaded files, export them and update the price lake"),
+    'augment': (['fuel_details', 'geocode'], "build the fuel details and geocode new addresses"),
+    'load': (['store', 'verify'], "load the cleaned data into DuckDB and check it"),
+    'run': (None, "run the whole pipeline"),
+}
+
+# First of the month from 'YYYY-MM' (or a full 'YYYY-MM-DD' date)
+def _month(value):
+    from datetime import date
+    parts = value.split('-')
+    return date(int(parts[0]), int(parts[1]), 1)
+
+def _date(value):
+    from datetime import date
+    return date.fromisoformat(value)
+
+# Query rows as an aligned text table, or CSV for scripts
+def print_rows(columns, rows, as_csv=False):
+    if as_csv:
+        import csv
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        return
+    cells = [[f"{value:.2f}" if isinstance(value, float) else str(value) for value in row] for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in cells]) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    print(f"({len(rows)} rows)")
+
+# Reports read from the DuckDB file; only duckdb and data_analytics are
+# imported, the rows are printed without pandas
+def run_query(args):
+    import data_analytics
+    if args.report == 'summary':
+        sql, params = data_analytics.price_summary_query(args.period, args.by, args.fuelcode, args.start, args.end)
+    elif args.report == 'average':
+        sql, params = data_analytics.average_price_by_fuelcode_query(args.start, args.end)
+    elif args.report == 'cheapest':
+        sql, params = data_analytics.cheapest_by_query(args.fuelcode, args.month, args.by, args.limit)
+    elif args.report == 'months':
+        sql, params = data_analytics.available_months_query()
+    else:
+        sql, params = args.statement, []
+    columns, rows = data_analytics.query_rows(sql, params, db_path=args.db)
+    print_rows(columns, rows, args.csv)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="FuelCheck price pipeline")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    for name, (_, help_text) in PIPELINE_COMMANDS.items():
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--workers', type=int, default=CLEANING_WORKERS,
+                             help="worker processes for cleaning (CLEANING_WORKERS)")
+        command.add_argument('--stream', action='store_true', default=STREAM_MODE,
+                             help="clean chunk by chunk with bounded memory (STREAM_MODE)")
+        command.add_argument('--incremental', action='store_true', default=INCREMENTAL_LOAD,
+                             help="only load new or changed months (INCREMENTAL_LOAD)")
+        command.add_argument('--skip-loaded', action='store_true', default=SKIP_LOADED_ROWS,
+                             help="append only rows not loaded before (SKIP_LOADED_ROWS)")
+        command.add_argument('--changed-only', action='store_true', default=CLEAN_CHANGED_ONLY,
+                             help="clean only new or changed monthly files (CLEAN_CHANGED_ONLY)")
+        command.add_argument('--offline-geocoding', action='store_true', default=OFFLINE_GEOCODING,
+                             help="geocode from the bundled reference data only, no Nominatim (OFFLINE_GEOCODING)")
+        command.add_argument('--force', default=','.join(FORCE_STAGES),
+                             help="comma-separated stages to run even when unchanged, or 'all' (FORCE_STAGES)")
+
+    query = commands.add_parser('query', help="print a report from the DuckDB file")
+    reports = query.add_subparsers(dest='report', metavar='report', required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', default=DUCKDB_FILE, help="DuckDB file to read")
+    common.add_argument('--csv', action='store_true', help="print CSV instead of a table")
+    summary = reports.add_parser('summary', parents=[common], help="price statistics per period and group")
+    summary.add_argument('--period', default='month', choices=['day', 'month'])
+    summary.add_argument('--by', default='fuelcode', choices=['fuelcode', 'brand', 'suburb', 'postcode'])
+    summary.add_argument('--fuelcode')
+    for report in [summary, reports.add_parser('average', parents=[common], help="average price per fuel code")]:
+        report.add_argument('--start', type=_date, help="first day (YYYY-MM-DD)")
+        report.add_argument('--end', type=_date, help="last day (YYYY-MM-DD)")
+    cheapest = reports.add_parser('cheapest', parents=[common], help="cheapest groups for a fuel in a month")
+    cheapest.add_argument('fuelcode')
+    cheapest.add_argument('month', type=_month, help="YYYY-MM")
+    cheapest.add_argument('--by', default='suburb', choices=['brand', 'suburb', 'postcode'])
+    cheapest.add_argument('--limit', type=int, default=10)
+    reports.add_parser('months', parents=[common], help="months with loaded prices")
+    sql = reports.add_parser('sql', parents=[common], help="run a SQL statement (read-only)")
+    sql.add_argument('statement')
+
+    # Arguments after 'bench' go to bench.py unchanged (see main)
+    commands.add_parser('bench', help="benchmark the pipeline on synthetic data (bench.py options)",
+                        add_help=False)
+    return parser
+
+# python main.py [command] ...; without a command the whole pipeline runs, as
+# it always has for cron
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ['bench']:
+        import bench
+        return bench.main(argv[1:])
 
-    # convert all text files to csv
-    convert_csv_to_txt_and_cleanup()
+    args = build_parser().parse_args(argv)
+    if args.command == 'query':
+        run_query(args)
+        return 0
+    if args.command is None:
+        run_stages()
+        return 0
+    run_stages(PIPELINE_COMMANDS[args.command][0], cleaning_workers=args.workers, stream=args.stream,
+               incremental=args.incremental, skip_loaded=args.skip_loaded,
+               force=[name for name in args.force.split(',') if name], changed_only=args.changed_only,
+               offline_geocoding=args.offline_geocoding)
+    return 0
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# 0: only errors and the run summary, 1: progress messages (the default),
+# 2: diagnostic summaries (null counts, describe(), samples, full tables) that
+# cost extra passes over the data
+VERBOSITY = int(os.environ.get('PIPELINE_VERBOSITY', '1'))
+# Where stage metrics go: 'jsonl', 'prometheus', 'both' or 'none'
+METRICS_FORMAT = os.environ.get('METRICS_FORMAT', 'jsonl')
+METRICS_JSONL_PATH = 'db/pipeline_metrics.jsonl'
+METRICS_PROMETHEUS_PATH = 'db/pipeline_metrics.prom'
+# Comma-separated stages to profile ('all' for every stage), and the profiler:
+# 'cprofile' (CPU, written to PROFILE_DIR) or 'tracemalloc' (Python allocations)
+PROFILE_STAGES = [name for name in os.environ.get('PROFILE_STAGES', '').split(',') if name]
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')
+PROFILE_DIR = 'db/profiles'
+
+def set_verbosity(level):
+    global VERBOSITY
+    VERBOSITY = level
+
+def verbose(level=2):
+    return VERBOSITY >= level
+
+# High-water mark of the process's resident memory so far (not of one stage:
+# it never goes down, so a stage after a heavy one reports the heavy one's
+# peak). None where the resource module is missing (Windows).
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS; worker processes
+    # (the cleaning pool) are covered by RUSAGE_CHILDREN
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def _file_bytes(paths):
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+# tracemalloc is process-wide, so only one stage at a time can use it
+_tracemalloc_lock = threading.Lock()
+
+# Measure one stage: wall and CPU time, the process's peak RSS so far and the
+# bytes of its input and output files. Yields a dict the caller can add rows_in /
+# rows_out (or any other counts) to. CPU time is process-wide, so it includes
+# whatever runs alongside the stage, and process_peak_rss_bytes is a high-water
+# mark for the whole run up to the stage's end. With profile='cprofile' the
+# stage's thread is profiled to PROFILE_DIR/<name>.prof; with
+# profile='tracemalloc' the stage's own peak of traced Python allocations is
+# recorded as tracemalloc_peak_bytes.
+@contextmanager
+def measure_stage(name, inputs=(), outputs=(), profile=None):
+    record = {'stage': name, 'bytes_read': _file_bytes(inputs)}
+    profiler = None
+    if profile == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == 'tracemalloc':
+        _tracemalloc_lock.acquire()
+        tracemalloc.start()
+
+    started_wall, started_cpu = time.perf_counter(), _cpu_seconds()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - started_wall, 6)
+        record['cpu_seconds'] = round(_cpu_seconds() - started_cpu, 6)
+        record['process_peak_rss_bytes'] = _peak_rss_bytes()
+        record['bytes_written'] = _file_bytes(outputs)
+
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIR, f'{name}.prof')
+            profiler.dump_stats(profile_path)
+            record['profile'] = profile_path
+            if verbose(2):
+                summary = io.StringIO()
+                pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(20)
+                print(summary.getvalue())
+        elif profile == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            record['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            _tracemalloc_lock.release()
+            if verbose(2):
+                for stat in snapshot.statistics('lineno')[:10]:
+                    print(stat)
+
+# Write the stage records of one run: appended as JSON lines and/or rewritten
+# as a Prometheus text-format file (for node_exporter's textfile collector)
+def emit_metrics(records, run_id, metrics_format=METRICS_FORMAT,
+                 jsonl_path=METRICS_JSONL_PATH, prometheus_path=METRICS_PROMETHEUS_PATH):
+    if metrics_format in ('jsonl', 'both'):
+        os.makedirs(os.path.dirname(jsonl_path) or '.', exist_ok=True)
+        with open(jsonl_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps({'run_id': run_id, **record}, default=str) + '\n')
+
+    if metrics_format in ('prometheus', 'both'):
+        lines = []
+        for metric in ['wall_seconds', 'cpu_seconds', 'process_peak_rss_bytes', 'bytes_read', 'bytes_written',
+                       'rows_in', 'rows_out', 'rows_rejected', 'tracemalloc_peak_bytes']:
+            samples = [record for record in records if record.get(metric) is not None]
+            if not samples:
+                continue
+            lines.append(f"# TYPE fuelcheck_stage_{metric} gauge")
+            for record in samples:
+                lines.append(f'fuelcheck_stage_{metric}{{stage="{record["stage"]}",status="{record.get("status", "")}"}} {record[metric]}')
+        # Counts per validation rule, one series per rule
+        for metric in ['rows_rejected_by_rule']:
+            samples = [record for record in records if record.get(metric)]
+            if not samples:
+                continue
+            lines.append(f"# TYPE fuelcheck_stage_{metric} gauge")
+            for record in samples:
+                for rule, count in sorted(record[metric].items()):
+                    lines.append(f'fuelcheck_stage_{metric}{{stage="{record["stage"]}",status="{record.get("status", "")}",'
+                                 f'rule="{rule}"}} {count}')
+        os.makedirs(os.path.dirname(prometheus_path) or '.', exist_ok=True)
+        tmp_file = prometheus_path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, prometheus_path)
@@ -0,0 +1,177 @@
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from metrics import measure_stage, emit_metrics, verbose, METRICS_FORMAT, PROFILE_STAGES, PROFILE_MODE
+
+# Fingerprints, file hashes and timings of the last run of every stage
+PIPELINE_STATE_PATH = 'db/pipeline_state.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# One step of the pipeline. inputs are file or directory paths (or a callable
+# returning them, for inputs only known once an earlier stage has run) and
+# outputs the files the stage writes. The stage runs again only when the hashes
+# of its inputs, its params or the source of its function and code modules
+# change, or an output is missing. always_run stages (e.g. network fetches) run
+# every time; stages downstream of them still skip when the files they produce
+# come out the same. func may return a dict of counts (e.g. rows_in, rows_out)
+# that is added to the stage's metrics.
+class Stage:
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), code=(), params=None, always_run=False):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.code = list(code)
+        self.params = params or {}
+        self.always_run = always_run
+
+    def input_paths(self):
+        return list(self.inputs() if callable(self.inputs) else self.inputs)
+
+# Stage records plus a memo of file hashes keyed by path, size and mtime, so
+# large inputs are only read again after they change
+class PipelineState:
+    def __init__(self, path=PIPELINE_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'stages': {}, 'files': {}}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def file_hash(self, path):
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    file_path = os.path.join(root, filename)
+                    digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                    digest.update(self.file_hash(file_path).encode('ascii'))
+            return digest.hexdigest()
+        if not os.path.exists(path):
+            return 'missing'
+
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            memo = self.data['files'].get(key)
+        if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(block)
+        with self.lock:
+            self.data['files'][key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def stage(self, name):
+        with self.lock:
+            return dict(self.data['stages'].get(name, {}))
+
+    def record(self, name, **fields):
+        with self.lock:
+            self.data['stages'].setdefault(name, {}).update(fields)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.path)
+
+# Code version of a stage: the source of its function and of its code modules
+def _code_hash(stage):
+    try:
+        source = inspect.getsource(stage.func).encode('utf-8')
+    except (OSError, TypeError):
+        # Functions defined interactively have no source file; use their bytecode
+        source = stage.func.__code__.co_code
+    digest = hashlib.sha256(source)
+    for module in stage.code:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def stage_fingerprint(stage, state):
+    digest = hashlib.sha256(_code_hash(stage).encode('ascii'))
+    digest.update(json.dumps(stage.params, sort_keys=True, default=str).encode('utf-8'))
+    for path in stage.input_paths():
+        digest.update(path.encode('utf-8'))
+        digest.update(state.file_hash(path).encode('ascii'))
+    return digest.hexdigest()
+
+# Run (or skip) one stage and return its metrics record
+def _run_stage(stage, state, force, profile, profile_mode):
+    fingerprint = stage_fingerprint(stage, state)
+    previous = state.stage(stage.name)
+    forced = stage.always_run or stage.name in force or 'all' in force
+    outputs_exist = all(os.path.exists(path) for path in stage.outputs)
+    if not forced and outputs_exist and previous.get('fingerprint') == fingerprint:
+        if verbose(1):
+            print(f"[{stage.name}] inputs unchanged, skipping")
+        state.record(stage.name, status='skipped')
+        return {'stage': stage.name, 'status': 'skipped', 'wall_seconds': 0.0}
+
+    if verbose(1):
+        print(f"[{stage.name}] running")
+    profiled = stage.name in profile or 'all' in profile
+    input_paths = stage.input_paths()
+    with measure_stage(stage.name, input_paths, stage.outputs, profile_mode if profiled else None) as record:
+        counts = stage.func()
+        if isinstance(counts, dict):
+            record.update(counts)
+    record['status'] = 'ran'
+    state.record(stage.name, status='ran', fingerprint=fingerprint, wall_time=round(record['wall_seconds'], 3),
+                 finished_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    if verbose(1):
+        print(f"[{stage.name}] finished in {record['wall_seconds']:.2f}s")
+    return record
+
+# Run the stages in dependency order. A stage starts as soon as every stage in
+# its `after` list is done, so independent stages run side by side (up to
+# max_workers). force names stages to run regardless of fingerprints ('all'
+# for every stage). profile names stages to run under profile_mode (see
+# metrics.measure_stage). The per-stage metrics are emitted in metrics_format
+# and returned as {stage name: record}.
+def run_pipeline(stages, state_path=PIPELINE_STATE_PATH, force=(), max_workers=2,
+                 profile=PROFILE_STAGES, profile_mode=PROFILE_MODE, metrics_format=METRICS_FORMAT):
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        unknown = set(stage.after) - names
+        if unknown:
+            raise ValueError(f"Stage '{stage.name}' runs after unknown stages: {sorted(unknown)}")
+
+    state = PipelineState(state_path)
+    pending = list(stages)
+    done = set()
+    running = {}
+    results = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in [stage for stage in pending if set(stage.after) <= done]:
+                pending.remove(stage)
+                running[executor.submit(_run_stage, stage, state, force, profile, profile_mode)] = stage
+            if not running:
+                raise ValueError(f"Stages depend on each other in a cycle: {[stage.name for stage in pending]}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                results[stage.name] = future.result()
+                done.add(stage.name)
+
+    records = [results[stage.name] for stage in stages]
+    emit_metrics(records, run_id=time.strftime('%Y%m%dT%H%M%S'), metrics_format=metrics_format)
+
+    print(f"\nPipeline finished in {time.perf_counter() - started:.2f}s")
+    for record in records:
+        rows = f"{record['rows_out']:>10} rows" if record.get('rows_out') is not None else ''
+        print(f"  {record['stage']:<14} {record['status']:<8} {record['wall_seconds']:8.2f}s {rows}")
+    return results